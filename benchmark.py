@@ -0,0 +1,366 @@
+"""記録したHARを再生して、取得とスプレッドシート書き込みの速さを測るベンチマーク
+
+ネットワークにもGoogleにも接続せずに、同じ条件で何度でも測定できる。
+
+    # 1. 実際のサイトから通信をHARファイルに記録（ネットワークが必要。1回だけ）
+    python benchmark.py record --har fedwatch.har
+
+    # 2. HARを再生して測定（ネットワーク不要。Sheets APIは手元の偽物に置き換える）
+    python benchmark.py run --har fedwatch.har --repeat 5 --output bench.json
+
+段階ごとの所要時間、PlaywrightとChromium間のやりとり（プロトコル呼び出し）の回数、
+Sheets APIの呼び出し回数をJSONで出力する。
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from contextlib import contextmanager, redirect_stdout
+from io import StringIO
+
+import main
+
+
+# --- Sheets APIの偽物（メモリ上で動き、呼び出し回数を数える） ---
+
+class _FakeRequest:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self, num_retries=0):
+        return self._fn()
+
+class FakeSheetsService:
+    """update_sheet が使う Sheets API の範囲だけをメモリ上で再現する偽物
+
+    calls に API呼び出しの回数、requests に batchUpdate 内の操作の回数を記録する。
+    セルは値だけを保持する（書式は回数だけ数える）。
+    """
+
+    def __init__(self, first_sheet_title="シート1"):
+        self.calls = {}
+        self.requests = {}
+        self._sheets = {}
+        self._add(first_sheet_title, 1000, 26)
+
+    # service.spreadsheets() / service.spreadsheets().values() はどちらも自分自身を返す
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, fields=None, range=None, **kwargs):
+        if range is not None:
+            return self._values_get(range)
+        def fn():
+            self._count('get')
+            return {'sheets': [{'properties': self._properties(sheet_id)} for sheet_id in self._sheets]}
+        return _FakeRequest(fn)
+
+    def _values_get(self, a1):
+        def fn():
+            self._count('values.get')
+            return self._read(a1)
+        return _FakeRequest(fn)
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        def fn():
+            self._count('values.batchGet')
+            return {'valueRanges': [self._read(a1) for a1 in ranges]}
+        return _FakeRequest(fn)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def fn():
+            self._count('batchUpdate')
+            replies = []
+            for request in body['requests']:
+                (kind, params), = request.items()
+                self.requests[kind] = self.requests.get(kind, 0) + 1
+                replies.append(self._apply(kind, params))
+            return {'replies': replies}
+        return _FakeRequest(fn)
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _add(self, title, rows, cols, sheet_id=None):
+        if sheet_id is None:
+            sheet_id = max(self._sheets, default=-1) + 1
+        if sheet_id in self._sheets or any(s['title'] == title for s in self._sheets.values()):
+            raise ValueError(f"同じIDまたは名前のシートがあります: {sheet_id} {title}")
+        self._sheets[sheet_id] = {'title': title, 'index': len(self._sheets), 'rows': rows, 'cols': cols, 'cells': {}}
+        return sheet_id
+
+    def _properties(self, sheet_id):
+        sheet = self._sheets[sheet_id]
+        return {
+            'sheetId': sheet_id,
+            'title': sheet['title'],
+            'index': sheet['index'],
+            'gridProperties': {'rowCount': sheet['rows'], 'columnCount': sheet['cols']}
+        }
+
+    def _read(self, a1):
+        """A1表記（'シート名'、'シート名'!A1、!A:A、!5:20 のみ対応）の値を返す"""
+        title, _, cell_range = a1.partition('!')
+        title = title[1:-1].replace("''", "'") if title.startswith("'") else title
+        sheet = next(s for s in self._sheets.values() if s['title'] == title)
+        cells = sheet['cells']
+        last_row = max((row for row, _ in cells), default=-1) + 1
+        last_col = max((col for _, col in cells), default=-1) + 1
+        row_start, row_end, col_start, col_end = 0, last_row, 0, last_col
+        if re.fullmatch(r'A:A', cell_range):
+            col_end = 1
+        elif re.fullmatch(r'\d+:\d+', cell_range):
+            first, last = cell_range.split(':')
+            row_start, row_end = int(first) - 1, int(last)
+        elif re.fullmatch(r'A1', cell_range):
+            row_end, col_end = 1, 1
+        values = []
+        for row in range(row_start, row_end):
+            cells_in_row = [cells.get((row, col), '') for col in range(col_start, col_end)]
+            while cells_in_row and cells_in_row[-1] == '':
+                cells_in_row.pop()
+            values.append(cells_in_row)
+        while values and not values[-1]:
+            values.pop()
+        return {'range': a1, 'values': values} if values else {'range': a1}
+
+    def _apply(self, kind, params):
+        if kind == 'addSheet':
+            properties = params['properties']
+            grid = properties.get('gridProperties', {})
+            sheet_id = self._add(properties['title'], grid.get('rowCount', 1000), grid.get('columnCount', 26),
+                                 properties.get('sheetId'))
+            return {'addSheet': {'properties': self._properties(sheet_id)}}
+        if kind == 'appendDimension':
+            sheet = self._sheets[params['sheetId']]
+            sheet['rows' if params['dimension'] == 'ROWS' else 'cols'] += params['length']
+        elif kind in ('insertDimension', 'deleteDimension'):
+            span = params['range']
+            sheet = self._sheets[span['sheetId']]
+            start, end = span['startIndex'], span['endIndex']
+            count = end - start
+            if kind == 'insertDimension':
+                sheet['cells'] = {(row + count if row >= start else row, col): value
+                                  for (row, col), value in sheet['cells'].items()}
+                sheet['rows'] += count
+            else:
+                sheet['cells'] = {(row - count if row >= end else row, col): value
+                                  for (row, col), value in sheet['cells'].items() if not start <= row < end}
+                sheet['rows'] -= count
+        elif kind == 'updateCells':
+            if 'rows' not in params:
+                self._sheets[params['range']['sheetId']]['cells'] = {}
+                return {}
+            start = params['start']
+            sheet = self._sheets[start['sheetId']]
+            for row_offset, row in enumerate(params['rows']):
+                for col_offset, cell in enumerate(row['values']):
+                    key = (start['rowIndex'] + row_offset, start.get('columnIndex', 0) + col_offset)
+                    if key[0] >= sheet['rows'] or key[1] >= sheet['cols']:
+                        raise ValueError(f"範囲外への書き込み: {sheet['title']} {key}")
+                    value = cell.get('userEnteredValue', {}).get('stringValue', '')
+                    if value:
+                        sheet['cells'][key] = value
+                    else:
+                        sheet['cells'].pop(key, None)
+        elif kind == 'copyPaste':
+            source, destination = params['source'], params['destination']
+            source_cells = self._sheets[source['sheetId']]['cells']
+            target = self._sheets[destination['sheetId']]
+            row_shift = destination['startRowIndex'] - source['startRowIndex']
+            for (row, col), value in list(source_cells.items()):
+                if source['startRowIndex'] <= row < source['endRowIndex']:
+                    target['cells'][(row + row_shift, col)] = value
+        return {}
+
+class _FakeGspreadClient:
+    """スプレッドシートを名前で開く部分（Drive検索）の偽物"""
+
+    def open(self, name):
+        class _Spreadsheet:
+            id = 'benchmark'
+        return _Spreadsheet()
+
+
+# --- 計測 ---
+
+@contextmanager
+def _count_protocol_calls(counter):
+    """PlaywrightからChromium（ドライバー）へのプロトコル呼び出しをメソッド名ごとに数える
+
+    Playwrightの内部API（Connection._send_message_to_server）を差し替えるため、ベンチマーク専用。
+    """
+    from playwright._impl._connection import Connection
+    original = Connection._send_message_to_server
+
+    def counting(self, object, method, *args, **kwargs):
+        counter[method] = counter.get(method, 0) + 1
+        return original(self, object, method, *args, **kwargs)
+
+    Connection._send_message_to_server = counting
+    try:
+        yield counter
+    finally:
+        Connection._send_message_to_server = original
+
+@contextmanager
+def _time_stages(timings):
+    """main._run_stage を包み、段階ごとの所要時間（秒）を記録する"""
+    original = main._run_stage
+
+    def timed(name, fn):
+        started = time.perf_counter()
+        try:
+            return original(name, fn)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+    main._run_stage = timed
+    try:
+        yield timings
+    finally:
+        main._run_stage = original
+
+def _use_fake_sheets(workdir):
+    """Sheets API・Drive・メタデータキャッシュを偽物と一時フォルダに切り替える"""
+    service = FakeSheetsService()
+    main._build_sheets_service = lambda: service
+    main._sheets_services = threading.local()
+    main._gc = _FakeGspreadClient()
+    main._sheets_cache = None
+    main.SHEETS_CACHE_FILE = os.path.join(workdir, "sheets_metadata.json")
+    return service
+
+def _run_once(session, workdir, verbose):
+    """HARを再生して1回取得し、偽物のSheetsに2回書き込む（初回と、履歴がある状態）"""
+    result = {'stages': {}, 'protocol_calls': {}}
+    main._trace = main._RunTrace()  # 再試行・セレクタの切り替え・API呼び出しの回数
+    log = sys.stdout if verbose else StringIO()
+    memory = main._MemorySampler()
+    with redirect_stdout(log), _time_stages(result['stages']), _count_protocol_calls(result['protocol_calls']), memory:
+        started = time.perf_counter()
+        table_data = main.scrape_fed_data(session)
+        result['stages']['scrape_total'] = time.perf_counter() - started
+    result['memory'] = memory.peaks()
+    result['table_hash'] = main._snapshot_hash(table_data)  # メモリ設定を変えても同じ表が取れているかの確認用
+
+    service = _use_fake_sheets(workdir)
+    with redirect_stdout(log):
+        main.update_sheet(table_data)  # 初回（前回値シートの作成を含む）
+        service.calls.clear()
+        service.requests.clear()
+        # 2回目は履歴の移動と前回値との比較を通す（UNCHANGED_POLICY=write なので毎回書き込む）
+        started = time.perf_counter()
+        main.update_sheet(table_data)
+        result['stages']['sheets_write'] = time.perf_counter() - started
+    result['sheets_calls'] = dict(service.calls)
+    result['sheets_requests'] = dict(service.requests)
+    result['rows'] = len(table_data['rows'])
+    result['counters'] = main._trace.counters
+    return result
+
+def _summarize(runs):
+    """複数回の結果を、段階ごとの中央値・最小値とプロトコル呼び出し回数の合計にまとめる"""
+    stage_names = sorted({name for run in runs for name in run['stages']})
+    return {
+        'runs': len(runs),
+        'stages': {
+            name: {
+                'median_s': round(statistics.median(run['stages'].get(name, 0.0) for run in runs), 4),
+                'min_s': round(min(run['stages'].get(name, 0.0) for run in runs), 4)
+            }
+            for name in stage_names
+        },
+        'protocol_calls_total': round(statistics.median(sum(run['protocol_calls'].values()) for run in runs)),
+        'protocol_calls': runs[-1]['protocol_calls'],
+        'sheets_calls': runs[-1]['sheets_calls'],
+        'sheets_requests': runs[-1]['sheets_requests'],
+        'counters': runs[-1]['counters'],
+        'memory_peak': {
+            name: max((run['memory'][name] for run in runs if run['memory'][name] is not None), default=None)
+            for name in runs[-1]['memory']
+        },
+        'table_hashes': sorted({run['table_hash'] for run in runs}),
+        'rows': runs[-1]['rows']
+    }
+
+def run_benchmark(har_file, repeat=3, extract_modes=("bulk", "cell"), verbose=False, memory_profiles=("standard",)):
+    """HARを再生して extract_modes ごとに repeat 回測定し、{方式: 集計結果} を返す
+    
+    memory_profiles を複数指定すると、組み合わせごとに測定する（キーは '方式:メモリ設定'）。
+    """
+    main.HAR_MODE = "replay"
+    main.HAR_FILE = har_file
+    main.STORAGE_STATE_FILE = ""  # 保存済みのブラウザ状態は使わない（毎回同じ条件にする）
+    main.HISTORY_KEEP_SNAPSHOTS = 0
+    main.UNCHANGED_POLICY = "write"
+    report = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for profile in memory_profiles:
+            main.MEMORY_PROFILE = profile
+            for mode in extract_modes:
+                main.EXTRACT_MODE = mode
+                label = mode if len(memory_profiles) == 1 else f"{mode}:{profile}"
+                runs = []
+                # ブラウザの起動は測定に含めない（1回目で起動し、以降は使い回す）
+                session = main._BrowserSession()
+                try:
+                    for index in range(repeat):
+                        runs.append(_run_once(session, workdir, verbose))
+                        print(f"[{label}] {index + 1}/{repeat}: 取得 {runs[-1]['stages']['scrape_total']:.2f}秒, "
+                              f"プロトコル呼び出し {sum(runs[-1]['protocol_calls'].values())}回")
+                finally:
+                    session.close()
+                report[label] = _summarize(runs)
+    return report
+
+def record_har(har_file):
+    """実際のサイトに接続して1回取得し、通信をHARファイルに記録する"""
+    main.HAR_MODE = "record"
+    main.HAR_FILE = har_file
+    session = main._BrowserSession()
+    try:
+        table_data = main.scrape_fed_data(session)
+    finally:
+        # HARファイルはコンテキストを閉じたときに書き出される
+        session.close()
+    print(f"記録しました: {har_file}（{len(table_data['rows'])}行）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="記録したHARを再生して、取得とスプレッドシート書き込みの速さを測ります")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="実際のサイトから通信をHARファイルに記録する")
+    record_parser.add_argument("--har", default="fedwatch.har", help="記録先のHARファイル")
+    run_parser = subparsers.add_parser("run", help="HARを再生して測定する（ネットワーク不要）")
+    run_parser.add_argument("--har", default="fedwatch.har", help="再生するHARファイル")
+    run_parser.add_argument("--repeat", type=int, default=3, help="方式ごとの測定回数")
+    run_parser.add_argument("--modes", default="bulk,cell", help="測定するテーブル取得方式（CME_EXTRACT_MODE、カンマ区切り）")
+    run_parser.add_argument("--memory-profiles", default="standard",
+                            help="測定するブラウザのメモリ設定（CME_MEMORY_PROFILE、カンマ区切り。例: standard,lean）")
+    run_parser.add_argument("--output", metavar="FILE", help="結果を書き出すJSONファイル（省略時は標準出力）")
+    run_parser.add_argument("--verbose", action="store_true", help="main.py のログも表示する")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_har(args.har)
+    else:
+        modes = tuple(m.strip() for m in args.modes.split(",") if m.strip())
+        profiles = tuple(p.strip() for p in args.memory_profiles.split(",") if p.strip())
+        report = run_benchmark(args.har, repeat=args.repeat, extract_modes=modes, verbose=args.verbose,
+                               memory_profiles=profiles)
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output)
+            print(f"結果を書き出しました: {args.output}")
+        else:
+            print(output)
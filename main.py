@@ -1,112 +1,1019 @@
 import os
+import sys
+import argparse
 import json
 import time
 import re
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from playwright.sync_api import sync_playwright
-from datetime import datetime
+import hashlib
+import gzip
+import random
+import asyncio
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+from html.parser import HTMLParser
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 # ==================== 設定定数 ====================
 # スクレイピング設定
 MAX_RETRIES = 3
 RETRY_DELAY = 10
+# 段階ごとの再試行回数（失敗した段階だけを、開いているページのままやり直す）
+# すべて失敗した場合に初めて、ページの再読み込み → ブラウザの再起動（MAX_RETRIES）に進む
+STAGE_RETRIES = {
+    "navigate": 1,
+    "find_iframe": 2,
+    "click_tab": 2,
+    "find_table": 2,
+    "extract": 2,
+}
+STAGE_BACKOFF_BASE = 1.0  # 段階の再試行の待機時間（秒）。再試行ごとに2倍し、ランダムな揺らぎを加える
+STAGE_BACKOFF_MAX = 8.0  # 段階の再試行の待機時間の上限（秒）
 PAGE_LOAD_TIMEOUT = 120000  # ミリ秒
 ELEMENT_WAIT_TIMEOUT = 10000  # ミリ秒
 # 定期実行（launchd）時は環境変数 CME_HEADLESS=1 でヘッドレスに。手動実行時はブラウザ表示
 HEADLESS_MODE = os.environ.get("CME_HEADLESS", "").strip() == "1"
+# テーブル取得方式: bulk=1回のevaluateで一括取得（既定） / cell=セルごとに取得（従来方式）
+EXTRACT_MODE = os.environ.get("CME_EXTRACT_MODE", "bulk").strip() or "bulk"
+# データ取得元: dom=テーブルのDOMから取得（既定） / network=iframeの通信レスポンスから取得（取得できなければDOM）
+CAPTURE_MODE = os.environ.get("CME_CAPTURE_MODE", "dom").strip() or "dom"
+# 通信の振り分け: off=すべて許可 / standard=画像・フォント・動画と広告・解析を遮断（既定） / fedwatch=テーブル取得に必要な通信だけ許可
+ROUTE_PROFILE = os.environ.get("CME_ROUTE_PROFILE", "standard").strip() or "standard"
+# ブラウザの保存状態（Cookieなど）を次回以降に再利用するファイル。空にすると再利用しない
+STORAGE_STATE_FILE = os.environ.get("CME_STORAGE_STATE", "browser_state.json").strip()
+# 保存状態の有効期限（時間）。期限を過ぎたら破棄して作り直す
+STORAGE_STATE_MAX_AGE_HOURS = float(os.environ.get("CME_STORAGE_STATE_MAX_AGE_HOURS", "24"))
+# 通信の記録・再生（HAR）: off=使わない（既定） / record=CME_HAR_FILE に記録 / replay=CME_HAR_FILE から再生（ネットワークに接続しない）
+HAR_MODE = os.environ.get("CME_HAR_MODE", "off").strip() or "off"
+HAR_FILE = os.environ.get("CME_HAR_FILE", "fedwatch.har").strip()
+# ディスク上のブラウザプロフィール（HTTPキャッシュ込み）を使う場合のフォルダ。指定時は STORAGE_STATE_FILE の代わりに使う
+BROWSER_PROFILE_DIR = os.environ.get("CME_BROWSER_PROFILE_DIR", "").strip()
+# ブラウザのメモリ設定: standard=従来どおり（既定） / lean=メモリの少ないVM向け
+# （小さい画面・ヘッドレスシェル・描画プロセス1つ・JSヒープの上限、表のiframe以外のiframeを閉じる）
+MEMORY_PROFILE = os.environ.get("CME_MEMORY_PROFILE", "standard").strip() or "standard"
+LEAN_VIEWPORT = {'width': 1024, 'height': 768}
+LEAN_JS_HEAP_MB = 512  # lean で1つの描画プロセスが使うJSヒープの上限（MB）
+MEMORY_SAMPLE_INTERVAL = 0.5  # メモリ使用量（RSS）を記録する間隔（秒）
 
-# 待機時間（秒）
-WAIT_AFTER_PAGE_LOAD = 3
-WAIT_AFTER_IFRAME_LOAD = 5
-WAIT_AFTER_TABLE_LOAD = 5
-WAIT_FOR_TABLE_DATA = 3
+# 待機の上限（ミリ秒）。固定時間ではなく、条件を満たした時点で次へ進む
+IFRAME_ATTACH_TIMEOUT = 30000  # quikstrikeのiframeが追加されるまで
+FRAME_NETWORK_IDLE_TIMEOUT = 15000  # iframe内の通信が落ち着くまで
+TAB_ACTIVE_TIMEOUT = 5000  # Probabilitiesタブが選択状態になるまで
+TABLE_STABLE_TIMEOUT = 20000  # テーブルの行数と内容が安定するまで
+TABLE_POLL_INTERVAL = 500  # テーブル安定確認のポーリング間隔
+
+# 同時に取得するビュー（quikstrike内のタブ名、カンマ区切り）と同時実行数。python main.py --views で使用
+SCRAPE_VIEWS = tuple(v.strip() for v in os.environ.get("CME_VIEWS", "Probabilities").split(",") if v.strip())
+VIEW_CONCURRENCY = int(os.environ.get("CME_VIEW_CONCURRENCY", "3"))
+
+# ライブモード（python main.py --live）で、変化をスプレッドシートなどに書き込む最短の間隔（秒）
+LIVE_FLUSH_SECONDS = float(os.environ.get("CME_LIVE_FLUSH_SECONDS", "30"))
+LIVE_POLL_INTERVAL = 1000  # ライブモードでブラウザからの通知を受け取る間隔（ミリ秒）
+
+# 常駐モード（python main.py --daemon）の実行時刻（日本時間）。CME_SCHEDULE_HOURS=9,15,21,3 の形式で変更可
+SCHEDULE_HOURS_JST = tuple(sorted(int(h) for h in os.environ.get("CME_SCHEDULE_HOURS", "9,15,21,3").split(",") if h.strip()))
+JST = timezone(timedelta(hours=9))
 
 # 比較閾値
 MIN_CHANGE_THRESHOLD = 0.1  # 0.1%以上の変化で矢印を表示
 
+# 前回から変化がなかったときの動作: marker=最新データの空行に「変化なし」の確認時刻だけ記録（既定）
+# / skip=何も書き込まない / write=変化がなくても毎回すべて書き込む（従来の動作）
+UNCHANGED_POLICY = os.environ.get("CME_UNCHANGED_POLICY", "marker").strip() or "marker"
+
+# 履歴シートに残す取得回数（ブロック数）。超えた分は古い順にアーカイブへ移す。0にすると無制限
+HISTORY_KEEP_SNAPSHOTS = int(os.environ.get("CME_HISTORY_KEEP", "120"))
+# アーカイブ先: sheet=月ごとのアーカイブシート（既定） / file=月ごとの圧縮ファイル（JSON Lines + gzip）
+HISTORY_ARCHIVE_MODE = os.environ.get("CME_HISTORY_ARCHIVE", "sheet").strip() or "sheet"
+HISTORY_ARCHIVE_DIR = os.environ.get("CME_HISTORY_ARCHIVE_DIR", "history_archive").strip() or "history_archive"
+HISTORY_ARCHIVE_BATCH = 20  # 上限をこの回数分超えたらまとめてアーカイブする（毎回少しずつ移さない）
+HISTORY_ARCHIVE_SHEET_PREFIX = "アーカイブ_"  # アーカイブシート名の接頭辞（例: アーカイブ_2026-01）
+
 # スプレッドシート設定
 SPREADSHEET_NAME = "CME定期調査"
+# 書き込み先のスプレッドシート名（カンマ区切り）。1回の取得結果を、それぞれの履歴・前回値シートへ並行して書き込む
+SPREADSHEET_TARGETS = [name.strip() for name in os.environ.get("CME_SPREADSHEETS", SPREADSHEET_NAME).split(",")
+                       if name.strip()] or [SPREADSHEET_NAME]
+SHEETS_TARGET_CONCURRENCY = max(1, int(os.environ.get("CME_SHEETS_CONCURRENCY", "4")))  # 同時に書き込むスプレッドシートの数
 PREVIOUS_SHEET_NAME = "前回値"
+SNAPSHOT_HASH_LABEL = "hash:"  # 前回値シートのヘッダー行末尾に保存する、前回データのハッシュの接頭辞
+UNCHANGED_MARKER_LABEL = "変化なし確認:"  # 変化がなかったときに最新ブロックの2行目に記録する確認時刻の接頭辞
 SERVICE_ACCOUNT_FILE = 'service_account.json'
+# スプレッドシートID・シートIDを保存しておくキャッシュ（毎回の名前検索とメタデータ取得を省く）
+SHEETS_CACHE_FILE = os.environ.get("CME_SHEETS_CACHE", os.path.join(".cme_cache", "sheets_metadata.json"))
+# 段階ごとに成功したセレクタと、セレクタごとの成功・失敗の回数を保存するファイル（次回は成功しやすい順に試す）。空なら保存しない
+SELECTOR_CACHE_FILE = os.environ.get("CME_SELECTOR_CACHE", os.path.join(".cme_cache", "selectors.json")).strip()
+
+# 取得した確率を1件ずつ保存するローカルの時系列データベース（SQLite）。空にすると保存しない
+HISTORY_DB_FILE = os.environ.get("CME_HISTORY_DB", "fedwatch_history.sqlite3").strip()
+
+# 取得結果をスプレッドシートに書き込む前に保存しておくファイル（JSON Lines）。書き込めなかった分は次回まとめて書き込む
+# 空にすると保存しない（書き込みに失敗した取得結果は失われる）
+SPOOL_FILE = os.environ.get("CME_SPOOL_FILE", "pending_snapshots.jsonl").strip()
+SPOOL_FLUSH_BATCH = 10  # 1回のbatchUpdateにまとめる取得結果の数
+# 取得結果そのものが原因で書き込めないとみなすステータス。該当する取得結果は書き込めない分のファイル（*.dead.jsonl）へ移し、
+# 後ろの取得結果の書き込みを止めない（401・403・404 は設定の問題なので、スプールに残して次回に再試行する）
+SPOOL_DEAD_LETTER_STATUSES = (400, 413, 422)
+SPOOL_RETRY_INTERVAL = 600  # 常駐モードで、書き込めなかった分を再試行する間隔（秒）
+
+# Google APIの呼び出し回数の上限（1分あたり）。Sheets APIの1ユーザーあたりの既定の割り当てに合わせている
+SHEETS_READ_PER_MINUTE = float(os.environ.get("CME_SHEETS_READ_PER_MINUTE", "60"))
+SHEETS_WRITE_PER_MINUTE = float(os.environ.get("CME_SHEETS_WRITE_PER_MINUTE", "60"))
+GOOGLE_API_RETRIES = 5  # 429（割り当て超過）・5xx のときの再試行回数
+GOOGLE_API_BACKOFF_BASE = 2.0  # 再試行の待機時間（秒）。再試行ごとに2倍し、ランダムな揺らぎを加える
+GOOGLE_API_BACKOFF_MAX = 64.0
+GOOGLE_API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 実行ごとの計測結果（段階ごとの所要時間と回数）を書き出すJSONファイル。空にすると書き出さない
+RUN_REPORT_FILE = os.environ.get("CME_RUN_REPORT", "run_report.json").strip()
+# Prometheus（node_exporter の textfile collector）向けに同じ内容を書き出すファイル（*.prom）。空なら書き出さない
+PROMETHEUS_TEXTFILE = os.environ.get("CME_PROMETHEUS_TEXTFILE", "").strip()
+
+# --- 計測（段階ごとの所要時間と回数） ---
+
+class _RunTrace:
+    """1回の実行について、段階ごとの所要時間と、再試行・APIの呼び出しなどの回数を記録する"""
+    
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self.stages = {}  # 段階名 → {'seconds': 合計秒, 'count': 実行回数}
+        self.counters = {}  # 名前 → 回数、または {種類: 回数}
+        self.memory = {}  # メモリ使用量（RSS）のピーク（バイト）。_MemorySampler.peaks() の結果
+        self._lock = threading.Lock()  # 書き込み先ごとのスレッドからも記録されるため
+    
+    @contextmanager
+    def stage(self, name):
+        """with の中の所要時間を段階 name に加算する（失敗した場合も記録する）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry = self.stages.setdefault(name, {'seconds': 0.0, 'count': 0})
+                entry['seconds'] += time.perf_counter() - started
+                entry['count'] += 1
+    
+    def count(self, name, amount=1, kind=None):
+        """回数を加算する（kind を指定すると種類ごとに分けて数える）"""
+        with self._lock:
+            if kind is None:
+                self.counters[name] = self.counters.get(name, 0) + amount
+            else:
+                by_kind = self.counters.setdefault(name, {})
+                by_kind[kind] = by_kind.get(kind, 0) + amount
+    
+    def report(self, status, error=None):
+        """計測結果を辞書にまとめる"""
+        return {
+            'started_at': self.started_at.isoformat(timespec="seconds"),
+            'duration_seconds': round(time.perf_counter() - self._started, 3),
+            'status': status,
+            'error': str(error) if error is not None else None,
+            'stages': {name: {'seconds': round(entry['seconds'], 3), 'count': entry['count']}
+                       for name, entry in self.stages.items()},
+            'counters': self.counters,
+            'memory': self.memory
+        }
+    
+    def write(self, status, error=None):
+        """計測結果を RUN_REPORT_FILE（JSON）と PROMETHEUS_TEXTFILE に書き出す"""
+        report = self.report(status, error)
+        if RUN_REPORT_FILE:
+            _write_file_atomically(RUN_REPORT_FILE, json.dumps(report, ensure_ascii=False, indent=2))
+        if PROMETHEUS_TEXTFILE:
+            _write_file_atomically(PROMETHEUS_TEXTFILE, _prometheus_text(report))
+        return report
+
+def _prometheus_text(report):
+    """計測結果を Prometheus のテキスト形式に変換（値は直近1回の実行分）"""
+    lines = [
+        f"cme_run_success {1 if report['status'] == 'ok' else 0}",
+        f"cme_run_duration_seconds {report['duration_seconds']}",
+        f"cme_run_timestamp_seconds {int(datetime.fromisoformat(report['started_at']).timestamp())}"
+    ]
+    for name, value in report.get('memory', {}).items():
+        if value is not None:
+            lines.append(f"cme_run_{name} {value}")
+    for name, entry in report['stages'].items():
+        lines.append(f'cme_run_stage_seconds{{stage="{name}"}} {entry["seconds"]}')
+        lines.append(f'cme_run_stage_count{{stage="{name}"}} {entry["count"]}')
+    for name, value in report['counters'].items():
+        metric = "cme_run_" + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        if isinstance(value, dict):
+            lines.extend(f'{metric}{{kind="{_prometheus_label(kind)}"}} {amount}' for kind, amount in value.items())
+        else:
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def _prometheus_label(value):
+    """ラベルの値をエスケープする（スプレッドシート名などをそのまま使うため）"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _write_file_atomically(path, text):
+    """一時ファイルに書いてから置き換える（読み取り側が書きかけの内容を読まないように）"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+_trace = _RunTrace()
+
+# --- メモリ使用量（RSS）の計測 ---
+
+class _MemorySampler:
+    """with の間、Python とブラウザ（Chromium）のメモリ使用量（RSS）を一定間隔で測り、ピークを記録する
+    
+    psutil がインストールされていればプロセスごとに測る。ない場合は Linux では /proc から測り、
+    /proc もなければ Python 分だけを resource（プロセス開始からのピーク、Windowsでは取得できない）で記録する。
+    """
+    
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.python_peak = None
+        self.browser_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import psutil
+            self._psutil = psutil
+            self._process = psutil.Process()
+        except ImportError:
+            self._psutil = None
+            self._process = None
+        self._use_proc = self._process is None and os.path.exists(f"/proc/{os.getpid()}/status")
+    
+    def __enter__(self):
+        if self._process is not None or self._use_proc:
+            self.sample()
+            self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+            self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.sample()
+        return False
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+    
+    def sample(self):
+        """現在のRSSを測り、ピークを更新する（ブラウザは子孫プロセスのうちChromiumの合計）"""
+        if self._process is not None:
+            try:
+                python_rss, browser_rss = self._psutil_sample()
+            except self._psutil.Error:
+                return
+        elif self._use_proc:
+            python_rss, browser_rss = _proc_memory_sample()
+            if python_rss is None:
+                return
+        else:
+            return
+        self.python_peak = max(self.python_peak or 0, python_rss)
+        if browser_rss:
+            self.browser_peak = max(self.browser_peak or 0, browser_rss)
+    
+    def _psutil_sample(self):
+        """psutil で (Python のRSS, Chromium のRSSの合計) を測る"""
+        python_rss = self._process.memory_info().rss
+        browser_rss = 0
+        for child in self._process.children(recursive=True):
+            try:
+                name = child.name().lower()
+                if "chrom" in name or "headless_shell" in name:
+                    browser_rss += child.memory_info().rss
+            except self._psutil.Error:
+                pass  # 測っている間に終了したプロセス
+        return python_rss, browser_rss
+    
+    def peaks(self):
+        """{'python_peak_rss_bytes': …, 'browser_peak_rss_bytes': …}（測れなかった項目は None）"""
+        return {
+            'python_peak_rss_bytes': self.python_peak or _python_max_rss(),
+            'browser_peak_rss_bytes': self.browser_peak
+        }
+
+def _proc_rss(pid):
+    """/proc/<pid>/status の VmRSS（バイト）。読めなければ None"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _proc_memory_sample(root_pid=None):
+    """psutil がない Linux で、/proc から (Python のRSS, 子孫プロセスのうちChromiumのRSSの合計) を測る"""
+    root_pid = root_pid or os.getpid()
+    children = {}
+    names = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="utf-8") as f:
+                stat = f.read()
+        except OSError:
+            continue  # 読んでいる間に終了したプロセス
+        # 形式: pid (comm) state ppid …（comm に空白や括弧が含まれてもよいように、最後の ')' で区切る）
+        name, _, rest = stat[stat.find("(") + 1:].rpartition(")")
+        try:
+            ppid = int(rest.split()[1])
+        except (IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+        names[int(entry)] = name.lower()
+    browser_rss = 0
+    stack = list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        if "chrom" in names[pid] or "headless_shell" in names[pid]:
+            browser_rss += _proc_rss(pid) or 0
+    return _proc_rss(root_pid), browser_rss
+
+def _python_max_rss():
+    """Python プロセスのRSSのピーク（プロセス開始から）。resource が使えない環境では None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux はキロバイト単位
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def _print_memory_use(memory):
+    """メモリ使用量のピークを表示"""
+    def megabytes(value):
+        return "不明" if value is None else f"{value / (1024 * 1024):.0f}MB"
+    browser = memory.get('browser_peak_rss_bytes')
+    note = "" if browser is not None else "（ブラウザ分は psutil をインストールするか、Linux で実行すると測れます）"
+    print(f"メモリ使用量のピーク: Python {megabytes(memory.get('python_peak_rss_bytes'))}"
+          f" / ブラウザ {megabytes(browser)}{note}")
+
+# --- Google APIの呼び出し（割り当てに合わせた間隔調整と、429・5xxの再試行） ---
+
+class _TokenBucket:
+    """1分あたり rate_per_minute 回までに抑える（短時間の集中は capacity 回まで許す）。複数スレッドで共有できる"""
+    
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 6)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """1回分の枠を確保し、必要なら枠が空くまで待つ"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1  # 先に確保しておく（足りない分は待つ）
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+_quota_buckets = {
+    'read': _TokenBucket(SHEETS_READ_PER_MINUTE),
+    'write': _TokenBucket(SHEETS_WRITE_PER_MINUTE)
+}
+
+def _quota_kind(name):
+    """API名から割り当ての種類（read / write）を返す（Sheets以外はNone）"""
+    if name.startswith("drive."):
+        return None
+    return 'write' if name.endswith("batchUpdate") else 'read'
+
+def _execute(request, name):
+    """Google APIのリクエストを実行する（_call_google を参照）"""
+    return _call_google(request.execute, name)
+
+def _call_google(fn, name):
+    """Google APIを呼び出す。割り当てを超えないように間隔を空け、429・5xx は待ってから再試行する
+    
+    待機時間は Retry-After があればそれに従い、なければ指数的に延ばす。
+    呼び出し回数・割り当ての使用量・待機時間・再試行の回数は計測結果に記録する。
+    """
+    quota_kind = _quota_kind(name)
+    for attempt in range(GOOGLE_API_RETRIES + 1):
+        if quota_kind is not None:
+            with _trace.stage("google_api_throttle"):
+                _quota_buckets[quota_kind].acquire()
+            _trace.count("google_api_quota", kind=quota_kind)
+        _trace.count("google_api_calls", kind=name)
+        try:
+            with _trace.stage("google_api"):
+                return fn()
+        except Exception as e:
+            status = _http_status(e)
+            if status not in GOOGLE_API_RETRY_STATUSES or attempt >= GOOGLE_API_RETRIES:
+                raise
+            delay = _retry_after_seconds(e)
+            if delay is None:
+                delay = _backoff_delay(attempt, base=GOOGLE_API_BACKOFF_BASE, cap=GOOGLE_API_BACKOFF_MAX)
+            _trace.count("google_api_retries", kind=str(status))
+            print(f"Google APIが {status} を返しました（{name}、{delay:.1f}秒後に再試行 {attempt + 1}/{GOOGLE_API_RETRIES}）")
+            time.sleep(delay)
+
+def _http_status(error):
+    """Google API（googleapiclient / gspread）のエラーからHTTPステータスを取り出す（なければNone）"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after_seconds(error):
+    """エラーの Retry-After ヘッダー（秒数）を返す（なければNone）"""
+    headers = getattr(error, 'resp', None)
+    if headers is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        return max(0.0, float(value)) if value is not None else None
+    except (AttributeError, TypeError, ValueError):
+        return None
 
 # --- 1. スプレッドシートの認証設定 ---
+# gspread / google-auth / googleapiclient / playwright は読み込みに時間がかかるため、
+# 使う関数の中で import する。認証も最初に使うときに行い、以降は使い回す
 scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-# ★注意: ローカルで動かす場合は、環境変数設定が面倒なので
-# JSONキーのファイル名を直接指定するのが一番簡単です
-# GitHub Actions実行時は環境変数から読み込む
-if os.environ.get("GCP_SA_KEY"):
-    # GitHub Actionsの場合
-    key_json = os.environ.get("GCP_SA_KEY")
-    creds = Credentials.from_service_account_info(json.loads(key_json), scopes=scopes)
-else:
-    # ローカル実行の場合: 同じフォルダに service_account.json を置いてください
-    if os.path.exists(SERVICE_ACCOUNT_FILE):
-        creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
-    else:
-        raise FileNotFoundError(f"認証ファイルが見つかりません: {SERVICE_ACCOUNT_FILE}")
 
-gc = gspread.authorize(creds)
+_creds = None
+_gc = None
+# Sheets APIのサービスはスレッドごとに作る（内部の httplib2 はスレッドセーフではないため）。認証情報は共有する
+_sheets_services = threading.local()
+def _get_credentials():
+    """サービスアカウントの認証情報を読み込む（2回目以降は読み込み済みのものを返す）"""
+    global _creds
+    if _creds is None:
+        from google.oauth2.service_account import Credentials
+        # ★注意: ローカルで動かす場合は、環境変数設定が面倒なので
+        # JSONキーのファイル名を直接指定するのが一番簡単です
+        # GitHub Actions実行時は環境変数から読み込む
+        if os.environ.get("GCP_SA_KEY"):
+            # GitHub Actionsの場合
+            key_json = os.environ.get("GCP_SA_KEY")
+            _creds = Credentials.from_service_account_info(json.loads(key_json), scopes=scopes)
+        else:
+            # ローカル実行の場合: 同じフォルダに service_account.json を置いてください
+            if os.path.exists(SERVICE_ACCOUNT_FILE):
+                _creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
+            else:
+                raise FileNotFoundError(f"認証ファイルが見つかりません: {SERVICE_ACCOUNT_FILE}")
+    return _creds
+
+def _get_gspread_client():
+    """gspreadのクライアントを作成（2回目以降は作成済みのものを返す）"""
+    global _gc
+    if _gc is None:
+        import gspread
+        _gc = gspread.authorize(_get_credentials())
+    return _gc
+
+def _get_sheets_service():
+    """Sheets APIのサービスを返す（スレッドごとに、2回目以降は作成済みのものを返す）"""
+    service = getattr(_sheets_services, 'service', None)
+    if service is None:
+        service = _sheets_services.service = _build_sheets_service()
+    return service
+
+def _build_sheets_service():
+    """Sheets APIのサービスを作成
+    
+    APIの定義（discovery document）はライブラリに同梱されているものを使う（取得の通信をしない）。
+    """
+    from googleapiclient.discovery import build
+    return build('sheets', 'v4', credentials=_get_credentials(), static_discovery=True, cache_discovery=False)
+
+# --- スプレッドシートのメタデータキャッシュ ---
+
+_sheets_cache = None
+# キャッシュは書き込み先ごとのスレッドで共有する。項目の追加・削除と保存はこのロックの中で行う
+_sheets_cache_lock = threading.RLock()
+
+def _load_sheets_cache():
+    """メタデータキャッシュを読み込む（2回目以降は読み込み済みのものを返す）"""
+    global _sheets_cache
+    with _sheets_cache_lock:
+        if _sheets_cache is None:
+            try:
+                with open(SHEETS_CACHE_FILE, encoding="utf-8") as f:
+                    _sheets_cache = json.load(f)
+            except (OSError, ValueError):
+                _sheets_cache = {}
+            # 以前の版が保存していたAPIの定義（大きいため、保存のたびに書き直さないように取り除く）
+            _sheets_cache.pop('discovery', None)
+        return _sheets_cache
+
+def _save_sheets_cache():
+    """メタデータキャッシュをファイルに保存（書き込み途中で壊れないように置き換える）"""
+    with _sheets_cache_lock:
+        if _sheets_cache is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(SHEETS_CACHE_FILE) or ".", exist_ok=True)
+            tmp_path = SHEETS_CACHE_FILE + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(_sheets_cache, f, ensure_ascii=False)
+            os.replace(tmp_path, SHEETS_CACHE_FILE)
+        except OSError as e:
+            print(f"メタデータキャッシュの保存でエラー（続行します）: {e}")
+
+def _invalidate_spreadsheet_cache(spreadsheet_name):
+    """スプレッドシートのID・シート情報のキャッシュを破棄"""
+    with _sheets_cache_lock:
+        spreadsheets = _load_sheets_cache().get('spreadsheets', {})
+        if spreadsheets.pop(spreadsheet_name, None) is not None:
+            print(f"スプレッドシート '{spreadsheet_name}' のキャッシュを破棄しました")
+            _save_sheets_cache()
+
+def _resolve_spreadsheet(spreadsheet_name):
+    """スプレッドシートのIDとシート情報 {シート名: {sheetId, title, index, rowCount, columnCount}} を返す
+    
+    キャッシュがあればAPIを呼ばない。ない場合だけ名前で検索（Drive）し、必要な項目だけ取得する。
+    """
+    with _sheets_cache_lock:
+        spreadsheets = _load_sheets_cache().setdefault('spreadsheets', {})
+        entry = spreadsheets.get(spreadsheet_name)
+    if entry is None:
+        spreadsheet_id = _call_google(lambda: _get_gspread_client().open(spreadsheet_name).id, "drive.open")
+        metadata = _execute(_get_sheets_service().spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(sheetId,title,index,gridProperties(rowCount,columnCount))'
+        ), "spreadsheets.get")
+        entry = {
+            'id': spreadsheet_id,
+            'sheets': {
+                sheet['properties']['title']: _sheet_info(sheet['properties'])
+                for sheet in metadata.get('sheets', [])
+            }
+        }
+        with _sheets_cache_lock:
+            spreadsheets[spreadsheet_name] = entry
+            _save_sheets_cache()
+        print(f"スプレッドシート '{spreadsheet_name}' のメタデータを取得してキャッシュしました")
+    return entry['id'], entry['sheets']
+
+def _sheet_info(properties):
+    """シートのプロパティから、書き込みに必要な項目だけを取り出す"""
+    grid = properties.get('gridProperties', {})
+    return {
+        'sheetId': properties['sheetId'],
+        'title': properties['title'],
+        'index': properties.get('index', 0),
+        'rowCount': grid.get('rowCount', 1000),
+        'columnCount': grid.get('columnCount', 26)
+    }
+
+def _add_sheet(spreadsheet_id, sheets, title, rows, cols):
+    """シートを追加し、シート情報（キャッシュ）にも登録"""
+    response = _execute(_get_sheets_service().spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={'requests': [{'addSheet': {'properties': {
+            'title': title,
+            'gridProperties': {'rowCount': rows, 'columnCount': cols}
+        }}}]}
+    ), "spreadsheets.batchUpdate")
+    sheet = _sheet_info(response['replies'][0]['addSheet']['properties'])
+    with _sheets_cache_lock:
+        sheets[title] = sheet
+        _save_sheets_cache()
+    return sheet
+
+def _new_sheet_request(sheets, title, rows, cols, requests):
+    """シートを追加する addSheet リクエストを requests に加え、シート情報（sheets）にも登録する
+    
+    シートIDをこちらで決めておくことで、同じbatchUpdateの後続のリクエストからそのシートを参照できる。
+    """
+    used_ids = {sheet['sheetId'] for sheet in sheets.values()}
+    sheet_id = random.randrange(1, 2**31)
+    while sheet_id in used_ids:
+        sheet_id = random.randrange(1, 2**31)
+    sheet = {
+        'sheetId': sheet_id,
+        'title': title,
+        'index': max((sheet['index'] for sheet in sheets.values()), default=-1) + 1,
+        'rowCount': rows,
+        'columnCount': cols
+    }
+    requests.append({'addSheet': {'properties': {
+        'sheetId': sheet_id,
+        'title': title,
+        'index': sheet['index'],
+        'gridProperties': {'rowCount': rows, 'columnCount': cols}
+    }}})
+    sheets[title] = sheet
+    return sheet
+
+def _is_not_found_error(error):
+    """Google APIの「見つからない」エラー（404）かどうか"""
+    return _http_status(error) == 404
 
 # --- 2. CME FedWatchからスクレイピング ---
 
-def _launch_browser(playwright):
-    """Chromiumブラウザを起動してコンテキストとページを作成"""
+# 広告・解析系のドメイン（off以外のプロファイルでは常に遮断）
+BLOCKED_DOMAINS = (
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net", "googlesyndication.com",
+    "googleadservices.com", "facebook.net", "facebook.com", "linkedin.com", "licdn.com",
+    "twitter.com", "ads-twitter.com", "bing.com", "hotjar.com", "demdex.net", "omtrdc.net",
+    "everesttech.net", "adnxs.com", "quantserve.com", "scorecardresearch.com", "taboola.com",
+    "outbrain.com", "youtube.com", "ytimg.com", "vimeo.com", "brightcove.net"
+)
+
+# 通信の振り分けルール（リソースの種類とドメインで許可・遮断を決める）
+# 背景色を getComputedStyle で取得するため、fedwatch でもスタイルシートは許可する
+ROUTE_PROFILES = {
+    "off": None,
+    "standard": {
+        "deny_types": {"image", "media", "font"},
+        "deny_domains": BLOCKED_DOMAINS,
+    },
+    "fedwatch": {
+        "allow_types": {"document", "script", "xhr", "fetch", "stylesheet"},
+        "allow_domains": ("cmegroup.com", "quikstrike.net"),
+        "deny_domains": BLOCKED_DOMAINS,
+    },
+}
+
+# --- 学習するセレクタの順番 ---
+
+class _SelectorCache:
+    """段階ごとに、セレクタの成功・失敗の回数と最後に成功したセレクタを記録し、試す順番を決める
+    
+    サイトの構造が変わっても、遅くなるのは変化に気づいた1回だけになる（次回から成功したセレクタを先に試す）。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._steps = None  # 段階名 → {'last_hit': セレクタ, 'stats': {セレクタ: {'hits', 'misses'}}}
+        self._dirty = False
+    
+    def _load(self):
+        if self._steps is None:
+            self._steps = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        self._steps = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"セレクタの記録を読み込めませんでした（最初から記録し直します）: {e}")
+        return self._steps
+    
+    def ordered(self, step, selectors, fallbacks=()):
+        """候補のセレクタを、最後に成功したもの → 成功率の高いもの → 元の順番 の順に並べ替える
+        
+        fallbacks（何にでも一致する最後の手段）は並べ替えず、常に最後に試す。
+        一度成功しただけで先頭に来ると、目的以外の要素に一致し続けて本来のセレクタを試さなくなるため。
+        """
+        entry = self._load().get(step, {})
+        last_hit = entry.get('last_hit')
+        stats = entry.get('stats', {})
+        
+        def rank(indexed):
+            index, selector = indexed
+            counts = stats.get(selector, {})
+            hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+            # 記録のないセレクタは成功率50%とみなす
+            return (selector != last_hit, -(hits + 1) / (hits + misses + 2), index)
+        
+        return [selector for _, selector in sorted(enumerate(selectors), key=rank)] + list(fallbacks)
+    
+    def record(self, step, selector, hit):
+        """セレクタの成功・失敗を記録する"""
+        entry = self._load().setdefault(step, {'last_hit': None, 'stats': {}})
+        counts = entry['stats'].setdefault(selector, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+        if hit:
+            entry['last_hit'] = selector
+        self._dirty = True
+    
+    def save(self):
+        """記録に変化があればファイルに書き出す"""
+        if not self._dirty or not self.path:
+            return
+        try:
+            _write_file_atomically(self.path, json.dumps(self._steps, ensure_ascii=False, indent=2))
+            self._dirty = False
+        except OSError as e:
+            print(f"セレクタの記録を保存できませんでした（続行します）: {e}")
+
+_selector_cache = _SelectorCache(SELECTOR_CACHE_FILE)
+
+def _domain_matches(host, domains):
+    """ホスト名がドメイン一覧のいずれか（またはそのサブドメイン）に一致するか"""
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+class _RequestFilter:
+    """context.route でリクエストを許可・遮断し、件数を記録する"""
+    
+    def __init__(self, profile_name):
+        if profile_name not in ROUTE_PROFILES:
+            print(f"警告: 不明な通信プロファイル '{profile_name}' のため、すべての通信を許可します")
+        self.profile_name = profile_name
+        self.rules = ROUTE_PROFILES.get(profile_name)
+        self.allowed = 0
+        self.blocked = 0
+    
+    def is_allowed(self, resource_type, url):
+        """リソースの種類とURLから、通信を許可するか判定"""
+        rules = self.rules
+        if not rules:
+            return True
+        host = (urlsplit(url).hostname or "").lower()
+        if not host:
+            return True  # data: や blob: はそのまま許可
+        if _domain_matches(host, rules.get("deny_domains", ())):
+            return False
+        if resource_type in rules.get("deny_types", ()):
+            return False
+        if "allow_types" in rules and resource_type not in rules["allow_types"]:
+            return False
+        if "allow_domains" in rules and not _domain_matches(host, rules["allow_domains"]):
+            return False
+        return True
+    
+    def handle(self, route):
+        """context.route のハンドラ"""
+        request = route.request
+        if self.is_allowed(request.resource_type, request.url):
+            self.allowed += 1
+            route.fallback()
+        else:
+            self.blocked += 1
+            route.abort()
+    
+    async def handle_async(self, route):
+        """context.route のハンドラ（async版）"""
+        request = route.request
+        if self.is_allowed(request.resource_type, request.url):
+            self.allowed += 1
+            await route.fallback()
+        else:
+            self.blocked += 1
+            await route.abort()
+    
+    def log_and_reset(self):
+        """許可・遮断した件数をログに出してリセット"""
+        if self.rules:
+            print(f"通信（{self.profile_name}）: 許可 {self.allowed}件 / 遮断 {self.blocked}件")
+        self.allowed = 0
+        self.blocked = 0
+
+def _launch_browser(playwright, request_filter=None):
+    """Chromiumブラウザを起動してコンテキストとページを作成（request_filter があれば通信を振り分け）
+    
+    保存済みの状態（Cookieなど）が有効期限内なら読み込む。
+    BROWSER_PROFILE_DIR を指定した場合はディスク上のプロフィールを使う（その場合 browser は None）。
+    """
+    launch_args, context_options = _browser_options()
+    
     # 元のコードと同じく、channel指定なしでPlaywrightのChromiumを使用
-    browser = playwright.chromium.launch(
-        headless=HEADLESS_MODE,
-        args=[
-            '--disable-blink-features=AutomationControlled',
-            '--disable-http2',  # HTTP/2を無効化（重要）
-            '--disable-dev-shm-usage',
-            '--no-sandbox',
-            '--disable-setuid-sandbox',
-            '--disable-web-security',
-            '--disable-features=IsolateOrigins,site-per-process'
-        ]
-    )
-    context = browser.new_context(
-        viewport={'width': 1920, 'height': 1080},
-        user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    )
+    if BROWSER_PROFILE_DIR:
+        print(f"ブラウザプロフィールを使用します: {BROWSER_PROFILE_DIR}")
+        browser = None
+        context = playwright.chromium.launch_persistent_context(
+            BROWSER_PROFILE_DIR,
+            headless=_headless(),
+            args=launch_args,
+            **context_options
+        )
+    else:
+        browser = playwright.chromium.launch(headless=_headless(), args=launch_args)
+        storage_state = _usable_storage_state()
+        if storage_state:
+            print(f"保存済みのブラウザ状態を読み込みます: {storage_state}")
+            context_options['storage_state'] = storage_state
+        context = browser.new_context(**context_options)
+    
+    # 不要な画像・フォント・広告などを読み込まないように振り分ける
+    if request_filter is not None and request_filter.rules:
+        context.route("**/*", request_filter.handle)
+    # 通信の記録・再生（後から登録したルートが優先されるので、再生時はHARにない通信を中断する）
+    har_options = _har_options()
+    if har_options:
+        context.route_from_har(HAR_FILE, **har_options)
     
-    page = context.new_page()
-    return browser, page
+    page = context.pages[0] if context.pages else context.new_page()
+    return browser, context, page
+
+def _browser_options():
+    """Chromiumの起動引数とコンテキストの設定（同期版・async版で共通）"""
+    disabled_features = ['IsolateOrigins', 'site-per-process']
+    launch_args = [
+        '--disable-blink-features=AutomationControlled',
+        '--disable-http2',  # HTTP/2を無効化（重要）
+        '--disable-dev-shm-usage',
+        '--no-sandbox',
+        '--disable-setuid-sandbox',
+        '--disable-web-security'
+    ]
+    viewport = {'width': 1920, 'height': 1080}
+    if MEMORY_PROFILE == "lean":
+        # 描画プロセスを1つにまとめ、JSヒープとキャッシュを小さく保つ
+        launch_args += [
+            '--renderer-process-limit=1',
+            '--enable-low-end-device-mode',
+            f'--js-flags=--max-old-space-size={LEAN_JS_HEAP_MB}',
+            '--aggressive-cache-discard',
+            '--disk-cache-size=1',
+            '--disable-gpu',
+            '--disable-extensions',
+            '--disable-background-networking',
+            '--disable-component-update',
+            '--mute-audio'
+        ]
+        disabled_features += ['BackForwardCache', 'Translate', 'MediaRouter', 'OptimizationHints']
+        viewport = LEAN_VIEWPORT
+    # --disable-features は最後に指定したものだけが有効になるため、1つにまとめる
+    launch_args.append('--disable-features=' + ','.join(disabled_features))
+    context_options = {
+        'viewport': viewport,
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    }
+    return launch_args, context_options
+
+def _headless():
+    """ヘッドレスで起動するか（lean では画面なしで軽いヘッドレスシェルを使うため、常にヘッドレス）"""
+    return HEADLESS_MODE or MEMORY_PROFILE == "lean"
+
+def _har_options():
+    """HAR_MODE に応じた route_from_har の引数（使わない場合はNone、同期版・async版で共通）"""
+    if HAR_MODE == "record":
+        print(f"通信をHARファイルに記録します: {HAR_FILE}")
+        return {'update': True, 'update_content': 'embed'}
+    if HAR_MODE == "replay":
+        if not os.path.exists(HAR_FILE):
+            raise FileNotFoundError(f"再生するHARファイルが見つかりません: {HAR_FILE}")
+        print(f"HARファイルから通信を再生します（ネットワークには接続しません）: {HAR_FILE}")
+        return {'not_found': 'abort'}
+    return None
+
+def _usable_storage_state():
+    """有効期限内の保存状態ファイルがあればそのパスを返す（期限切れなら削除）"""
+    if not STORAGE_STATE_FILE or not os.path.exists(STORAGE_STATE_FILE):
+        return None
+    age_hours = (time.time() - os.path.getmtime(STORAGE_STATE_FILE)) / 3600
+    if age_hours > STORAGE_STATE_MAX_AGE_HOURS:
+        print(f"保存済みのブラウザ状態が期限切れのため作り直します（{age_hours:.1f}時間経過）")
+        _discard_storage_state_file()
+        return None
+    return STORAGE_STATE_FILE
+
+def _discard_storage_state_file():
+    """保存状態ファイルを削除"""
+    try:
+        os.remove(STORAGE_STATE_FILE)
+    except OSError:
+        pass
 
-def _navigate_to_page(page, url, attempt):
-    """指定されたURLにページを遷移（元のコードと同じ動作）"""
-    print(f"サイトへアクセス中... (chromium, 試行 {attempt + 1}/{MAX_RETRIES})")
-    page.goto(url, wait_until="domcontentloaded", timeout=PAGE_LOAD_TIMEOUT)
+def _navigate_to_page(page, url, attempt, reload=False):
+    """指定されたURLにページを遷移し（reload=True なら再読み込み）、quikstrikeのiframeが追加されるまで待機"""
+    if reload:
+        print(f"ページを再読み込み中... (chromium, 試行 {attempt + 1}/{MAX_RETRIES})")
+        page.reload(wait_until="domcontentloaded", timeout=PAGE_LOAD_TIMEOUT)
+    else:
+        print(f"サイトへアクセス中... (chromium, 試行 {attempt + 1}/{MAX_RETRIES})")
+        page.goto(url, wait_until="domcontentloaded", timeout=PAGE_LOAD_TIMEOUT)
     print("ページ遷移成功")
-    # 追加の待機時間（元のコードと同じ）
-    time.sleep(WAIT_AFTER_PAGE_LOAD)
     
-    # ページが完全に読み込まれるまで待機（元のコードと同じ）
+    # 固定時間ではなく、iframeがDOMに追加されるまで待機
     print("ページの読み込みを待機中...")
-    time.sleep(5)  # 元のコードと同じ固定時間待機
+    _wait_for(
+        "iframeの追加",
+        lambda: page.wait_for_selector(
+            "iframe[src*='quikstrike'], iframe[src*='fedwatch']",
+            state="attached",
+            timeout=IFRAME_ATTACH_TIMEOUT
+        )
+    )
     
     # ページが読み込まれたか確認
     print(f"ページタイトル: {page.title()}")
     print(f"現在のURL: {page.url}")
 
+def _wait_for(label, wait_fn):
+    """条件待機を実行し、かかった時間をログに出す（上限に達した場合は警告して続行）"""
+    started = time.perf_counter()
+    try:
+        wait_fn()
+        print(f"待機完了: {label}（{time.perf_counter() - started:.2f}秒）")
+        return True
+    except Exception as e:
+        print(f"警告: {label}の待機が上限に達しました（{time.perf_counter() - started:.2f}秒、続行します）: {e}")
+        return False
+
+def _poll_until(check_fn, timeout_ms, interval_ms=TABLE_POLL_INTERVAL):
+    """check_fn が True を返すまでポーリング（上限を超えたら例外）"""
+    deadline = time.perf_counter() + timeout_ms / 1000
+    while True:
+        if check_fn():
+            return
+        if time.perf_counter() >= deadline:
+            raise TimeoutError(f"{timeout_ms}ms以内に条件を満たしませんでした")
+        time.sleep(interval_ms / 1000)
+
+def _wait_for_frame_idle(frame, label):
+    """iframe内の通信が落ち着くまで待機"""
+    if hasattr(frame, 'wait_for_load_state'):
+        _wait_for(label, lambda: frame.wait_for_load_state("networkidle", timeout=FRAME_NETWORK_IDLE_TIMEOUT))
+    else:
+        # FrameLocatorの場合は読み込み状態を取得できないため、body の追加を待つ
+        _wait_for(label, lambda: frame.locator("body").wait_for(state="attached", timeout=FRAME_NETWORK_IDLE_TIMEOUT))
+
+# 指定したタブ（またはその親要素）が選択状態になっているか判定するJS
+_TAB_ACTIVE_JS = """
+(label) => {
+    const isActive = (el) => {
+        for (let node = el, depth = 0; node && depth < 4; node = node.parentElement, depth++) {
+            if (node.getAttribute && (node.getAttribute('aria-selected') === 'true' || /(^|\\s|-)(active|selected|current)(\\s|$)/i.test(node.className || ''))) {
+                return true;
+            }
+        }
+        return false;
+    };
+    const candidates = Array.from(document.querySelectorAll('a, li, span, button, [data-item]'))
+        .filter(el => (el.textContent || '').trim() === label);
+    return candidates.some(isActive);
+}
+"""
+
+def _wait_for_tab_active(frame, label="Probabilities"):
+    """タブ（既定はProbabilities）が選択状態になるまで待機（選択状態になれば True）"""
+    return _wait_for(
+        f"{label}タブの選択",
+        lambda: _poll_until(lambda: _evaluate_in_frame(frame, _TAB_ACTIVE_JS, label), TAB_ACTIVE_TIMEOUT, interval_ms=200)
+    )
+
+# テーブルの行数と内容のハッシュを返すJS（2回連続で同じなら安定とみなす）
+_TABLE_SIGNATURE_JS = """
+() => {
+    const rows = document.querySelectorAll('table tr');
+    const text = Array.from(document.querySelectorAll('table')).map(t => t.innerText).join('\\n');
+    let hash = 0;
+    for (let i = 0; i < text.length; i++) {
+        hash = (hash * 31 + text.charCodeAt(i)) | 0;
+    }
+    return {rows: rows.length, hash: hash, has_data: text.indexOf('%') >= 0};
+}
+"""
+
+def _wait_for_table_stable(frame):
+    """テーブルの行数とセルのテキストが2回のポーリングで変化しなくなるまで待機"""
+    last_signature = [None]
+    
+    def is_stable():
+        signature = _evaluate_in_frame(frame, _TABLE_SIGNATURE_JS)
+        stable = signature['rows'] > 0 and signature['has_data'] and signature == last_signature[0]
+        last_signature[0] = signature
+        return stable
+    
+    _wait_for("テーブルデータの安定", lambda: _poll_until(is_stable, TABLE_STABLE_TIMEOUT))
+
+# quikstrikeのiframeの候補（上から順に試す。実際の順番は _selector_cache が成功の記録から決める）
+IFRAME_SELECTORS = (
+    "iframe[src*='quikstrike']",
+    "iframe[src*='fedwatch']"
+)
+IFRAME_FALLBACK_SELECTORS = ("iframe",)  # どのiframeにも一致するため、常に最後に試す
+
 def _find_iframe(page):
     """ページ内のiframeを検索"""
     print("iframeを探しています...")
-    iframe_selectors = [
-        "iframe[src*='quikstrike']",
-        "iframe[src*='fedwatch']",
-        "iframe"
-    ]
     
-    for selector in iframe_selectors:
+    for index, selector in enumerate(_selector_cache.ordered("find_iframe", IFRAME_SELECTORS, IFRAME_FALLBACK_SELECTORS)):
+        if index > 0:
+            _trace.count("selector_fallbacks", kind="find_iframe")
         try:
             iframes = page.locator(selector).all()
             if iframes:
                 print(f"iframeが見つかりました: {selector} ({len(iframes)}個)")
+                _selector_cache.record("find_iframe", selector, hit=True)
+                # Frame本体を取得できればそれを返す（frame.evaluateで一括取得できるように）
+                content_frame = iframes[0].element_handle().content_frame()
+                if content_frame is not None:
+                    # 最後の手段で見つけたiframeは表のものとは限らないため、ほかのiframeは閉じない
+                    if MEMORY_PROFILE == "lean" and selector not in IFRAME_FALLBACK_SELECTORS:
+                        _close_other_frames(page, content_frame)
+                    return content_frame
                 return page.frame_locator(selector).first
         except Exception:
-            continue
+            pass
+        _selector_cache.record("find_iframe", selector, hit=False)
     
     # iframeが見つからない場合のデバッグ情報
     print("iframeが見つかりませんでした。ページの構造を確認します...")
@@ -117,28 +1024,76 @@ def _find_iframe(page):
         print("ページ内に'quikstrike'または'fedwatch'の文字列が見つかりませんでした")
     raise Exception("iframeが見つかりませんでした")
 
+# トップページのiframeのうち、keep（表のiframe）以外を取り除いて数を返す
+_CLOSE_OTHER_FRAMES_JS = """
+(keep) => {
+    let closed = 0;
+    for (const frame of Array.from(document.querySelectorAll('iframe, frame'))) {
+        if (frame !== keep) {
+            frame.remove();
+            closed++;
+        }
+    }
+    return closed;
+}
+"""
+
+def _close_other_frames(page, frame):
+    """表のiframe以外のトップページのiframe（広告・動画など）を閉じて、描画プロセスのメモリを減らす"""
+    top = frame
+    while top.parent_frame is not None and top.parent_frame != page.main_frame:
+        top = top.parent_frame
+    try:
+        closed = page.evaluate(_CLOSE_OTHER_FRAMES_JS, top.frame_element())
+    except Exception as e:
+        print(f"ほかのiframeを閉じられませんでした（続行します）: {e}")
+        return
+    if closed:
+        _trace.count("frames_closed", closed)
+        print(f"表以外のiframeを{closed}個閉じました")
+
+async def _close_other_frames_async(page, frame):
+    """_close_other_frames のasync版"""
+    top = frame
+    while top.parent_frame is not None and top.parent_frame != page.main_frame:
+        top = top.parent_frame
+    try:
+        closed = await page.evaluate(_CLOSE_OTHER_FRAMES_JS, await top.frame_element())
+    except Exception as e:
+        print(f"ほかのiframeを閉じられませんでした（続行します）: {e}")
+        return
+    if closed:
+        _trace.count("frames_closed", closed)
+
+def _tab_selectors(label):
+    """タブ名からクリック候補のセレクタ一覧を作成"""
+    return [
+        f"text={label}",
+        f"a:has-text('{label}')",
+        f"[data-item='{label}']",
+        f"li:has-text('{label}')",
+        f".nav-item:has-text('{label}')"
+    ]
+
 def _click_probabilities(frame):
     """Probabilitiesタブをクリック"""
     print("'Probabilities'をクリックしています...")
-    prob_selectors = [
-        "text=Probabilities",
-        "a:has-text('Probabilities')",
-        "[data-item='Probabilities']",
-        "li:has-text('Probabilities')",
-        ".nav-item:has-text('Probabilities')"
-    ]
+    prob_selectors = _selector_cache.ordered("click_tab:Probabilities", _tab_selectors("Probabilities"))
     
-    for selector in prob_selectors:
+    for index, selector in enumerate(prob_selectors):
+        if index > 0:
+            _trace.count("selector_fallbacks", kind="click_tab")
         try:
             prob_link = frame.locator(selector).first
             if prob_link.is_visible(timeout=ELEMENT_WAIT_TIMEOUT // 2):
                 print(f"Probabilitiesリンクが見つかりました: {selector}")
                 prob_link.click()
                 print("Probabilitiesをクリックしました")
+                _selector_cache.record("click_tab:Probabilities", selector, hit=True)
                 return True
         except Exception as e:
             print(f"セレクタ '{selector}' でエラー: {e}")
-            continue
+        _selector_cache.record("click_tab:Probabilities", selector, hit=False)
     
     print("警告: Probabilitiesが見つかりませんでした。既に選択されている可能性があります。")
     return False
@@ -147,24 +1102,29 @@ def _find_table(frame):
     """iframe内のテーブルを検索（元のコードと同じ）"""
     print("テーブル全体からデータを取得中...")
     
-    table_selectors = ["table", "table tbody"]
-    for selector in table_selectors:
+    table_selectors = _selector_cache.ordered("find_table", ["table", "table tbody"])
+    for index, selector in enumerate(table_selectors):
+        if index > 0:
+            _trace.count("selector_fallbacks", kind="find_table")
         try:
             table_locator = frame.locator(selector).first
             table_locator.wait_for(state="attached", timeout=ELEMENT_WAIT_TIMEOUT)
             print(f"テーブルが見つかりました: {selector}")
+            _selector_cache.record("find_table", selector, hit=True)
             return table_locator
         except Exception:
-            continue
+            _selector_cache.record("find_table", selector, hit=False)
     
     raise Exception("テーブルが見つかりませんでした")
 
 def _extract_table_header(frame):
     """テーブルのヘッダー行を取得"""
     print("ヘッダー行を取得中...")
-    header_selectors = ["thead tr", "table tr:first-child", "tr:first-child"]
+    header_selectors = _selector_cache.ordered("table_header", ["thead tr", "table tr:first-child"], ["tr:first-child"])
     
-    for selector in header_selectors:
+    for index, selector in enumerate(header_selectors):
+        if index > 0:
+            _trace.count("selector_fallbacks", kind="table_header")
         try:
             header = frame.locator(selector).first
             header.wait_for(state="attached", timeout=ELEMENT_WAIT_TIMEOUT // 2)
@@ -172,9 +1132,11 @@ def _extract_table_header(frame):
             if len(header_cells) > 0:
                 header_row = [cell.inner_text() for cell in header_cells]
                 print(f"ヘッダー行を取得: {header_row}")
+                _selector_cache.record("table_header", selector, hit=True)
                 return header_row
         except Exception:
-            continue
+            pass
+        _selector_cache.record("table_header", selector, hit=False)
     
     return None
 
@@ -183,9 +1145,11 @@ def _extract_table_rows(frame, header_row):
     print("データ行を取得中...")
     data_rows = []
     cell_colors = []
-    row_selectors = ["tbody tr", "table tr"]
+    row_selectors = _selector_cache.ordered("table_rows", ["tbody tr", "table tr"])
     
-    for selector in row_selectors:
+    for index, selector in enumerate(row_selectors):
+        if index > 0:
+            _trace.count("selector_fallbacks", kind="table_rows")
         try:
             rows = frame.locator(selector).all()
             if len(rows) > 0:
@@ -214,7 +1178,7 @@ def _extract_table_rows(frame, header_row):
                                 row_color_info.append(None)
                         
                         # データが有効な行か確認（%や数値が含まれる）
-                        if len(row_data) > 0 and any('%' in cell or cell.replace('.', '').replace('/', '').replace('-', '').isdigit() for cell in row_data):
+                        if _is_data_row(row_data):
                             data_rows.append(row_data)
                             # 取得日時列と空列を考慮して、色情報にもNoneを2つ追加
                             cell_colors.append([None, None] + row_color_info)
@@ -224,13 +1188,117 @@ def _extract_table_rows(frame, header_row):
                 
                 if len(data_rows) > 0:
                     print(f"データ行を{len(data_rows)}行取得しました（色情報も含む）")
+                    _selector_cache.record("table_rows", selector, hit=True)
                     return data_rows, cell_colors
         except Exception as e:
             print(f"行取得エラー: {e}")
-            continue
+        _selector_cache.record("table_rows", selector, hit=False)
+    
+    raise Exception("データ行が見つかりませんでした")
+
+def _is_data_row(row_data):
+    """データが有効な行か判定（%や数値が含まれる）"""
+    return len(row_data) > 0 and any('%' in cell or cell.replace('.', '').replace('/', '').replace('-', '').isdigit() for cell in row_data)
+
+# ヘッダー・全行のテキスト・全セルの背景色を1回で取得するJS
+# セレクタの優先順位は _extract_table_header / _extract_table_rows と同じ
+_TABLE_SNAPSHOT_JS = """
+() => {
+    const cache = new Map();
+    const cellInfo = (cell) => {
+        if (!cache.has(cell)) {
+            const style = window.getComputedStyle(cell);
+            cache.set(cell, [cell.innerText, style.backgroundColor || style.background || 'transparent']);
+        }
+        return cache.get(cell);
+    };
+    const readRow = (row, cellSelector) => {
+        const infos = Array.from(row.querySelectorAll(cellSelector)).map(cellInfo);
+        return {texts: infos.map(info => info[0]), colors: infos.map(info => info[1])};
+    };
+
+    let header = null;
+    for (const selector of ['thead tr', 'table tr:first-child', 'tr:first-child']) {
+        const row = document.querySelector(selector);
+        if (row && row.querySelectorAll('th, td').length > 0) {
+            header = readRow(row, 'th, td').texts;
+            break;
+        }
+    }
+
+    const rowSets = [];
+    for (const selector of ['tbody tr', 'table tr']) {
+        const rows = Array.from(document.querySelectorAll(selector));
+        if (rows.length > 0) {
+            rowSets.push({selector: selector, rows: rows.map(row => readRow(row, 'td, th'))});
+        }
+    }
+    return {header: header, row_sets: rowSets};
+}
+"""
+
+def _evaluate_in_frame(frame, script, arg=None):
+    """iframe内でJSを1回だけ評価（FrameでもFrameLocatorでも動作）"""
+    if hasattr(frame, 'evaluate'):
+        return frame.evaluate(script, arg)
+    # FrameLocatorの場合はルート要素経由で評価する
+    return frame.locator(":root").evaluate(f"(el, arg) => ({script})(arg)", arg)
+
+def _table_from_snapshot(snapshot):
+    """一括取得したスナップショットを {'header', 'rows', 'cell_colors'} 形式に変換"""
+    header_row = snapshot.get('header') or None
+    start_idx = 1 if header_row else 0
+    
+    for row_set in snapshot.get('row_sets', []):
+        data_rows = []
+        cell_colors = []
+        for raw_row in row_set['rows'][start_idx:]:
+            row_data = [text.strip() for text in raw_row['texts']]
+            if _is_data_row(row_data):
+                data_rows.append(row_data)
+                # 取得日時列と空列を考慮して、色情報にもNoneを2つ追加
+                cell_colors.append([None, None] + [_parse_color_to_rgb(color) for color in raw_row['colors']])
+        
+        if len(data_rows) > 0:
+            return {
+                'header': header_row if header_row else [],
+                'rows': data_rows,
+                'cell_colors': cell_colors
+            }
     
     raise Exception("データ行が見つかりませんでした")
 
+def _extract_table_bulk(frame):
+    """ヘッダー・データ行・色情報を1回のevaluateでまとめて取得"""
+    print("テーブルを一括取得中...")
+    started = time.perf_counter()
+    snapshot = _evaluate_in_frame(frame, _TABLE_SNAPSHOT_JS)
+    table = _table_from_snapshot(snapshot)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"ヘッダー行を取得: {table['header']}")
+    print(f"データ行を{len(table['rows'])}行取得しました（色情報も含む、{elapsed_ms:.0f}ms）")
+    return table
+
+def _extract_table(frame):
+    """テーブル全体（ヘッダー・データ行・色情報）を取得"""
+    if EXTRACT_MODE == "bulk":
+        try:
+            return _extract_table_bulk(frame)
+        except Exception as e:
+            print(f"一括取得でエラー（セル単位の取得に切り替えます）: {e}")
+    
+    # ヘッダー行を取得
+    header_row = _extract_table_header(frame)
+    
+    # データ行と色情報を取得
+    data_rows, cell_colors = _extract_table_rows(frame, header_row)
+    
+    return {
+        'header': header_row if header_row else [],
+        'rows': data_rows,
+        'cell_colors': cell_colors
+    }
+
 def _parse_color_to_rgb(bg_color):
     """背景色文字列をGoogleスプレッドシート用のRGB形式に変換"""
     if not bg_color or bg_color in ['transparent', 'rgba(0, 0, 0, 0)', 'unknown', '']:
@@ -256,170 +1324,817 @@ def _parse_color_to_rgb(bg_color):
     
     return None
 
-def scrape_fed_data():
-    """CME FedWatchサイトからデータをスクレイピング（元のコードの動作を再現）"""
-    url = "https://www.cmegroup.com/ja/markets/interest-rates/cme-fedwatch-tool.html"
+# --- 通信レスポンスからのテーブル取得（CME_CAPTURE_MODE=network） ---
+
+class _ResponseCapture:
+    """quikstrikeのiframeが受信したレスポンスを記録し、確率テーブルを復元する"""
+    
+    RESOURCE_TYPES = ('xhr', 'fetch', 'document')
+    
+    def __init__(self, page):
+        self.responses = []
+        self._page = page
+        page.on("response", self._on_response)
     
-    for attempt in range(MAX_RETRIES):
+    def detach(self):
+        """レスポンスの記録を終了（常駐モードでページを使い回すため）"""
         try:
-            with sync_playwright() as p:
-                # Chromiumブラウザを起動
-                browser, page = _launch_browser(p)
-                
+            self._page.remove_listener("response", self._on_response)
+        except Exception:
+            pass
+    
+    def _on_response(self, response):
+        # イベントハンドラ内では本文を読まず、Responseだけ保持する（本文は extract_table で読む）
+        try:
+            if 'quikstrike' in response.url.lower() and response.request.resource_type in self.RESOURCE_TYPES:
+                self.responses.append(response)
+        except Exception:
+            pass
+    
+    def extract_table(self):
+        """記録したレスポンスを新しい順に解析し、最初に見つかった確率テーブルを返す"""
+        print(f"通信レスポンスからテーブルを探しています（{len(self.responses)}件）...")
+        for response in reversed(self.responses):
+            try:
+                body = response.text()
+            except Exception:
+                continue
+            table = _table_from_payload(body, response.headers.get('content-type', ''))
+            if table:
+                print(f"通信レスポンスからテーブルを取得しました: {response.url}")
+                print(f"データ行を{len(table['rows'])}行取得しました（全精度）")
+                return table
+        return None
+
+def _table_from_payload(body, content_type=''):
+    """レスポンス本文（JSON / HTML / ASP.NETの部分更新）から確率テーブルを復元"""
+    if not body:
+        return None
+    stripped = body.lstrip()
+    if 'json' in content_type.lower() or stripped[:1] in ('{', '['):
+        try:
+            return _table_from_json(json.loads(stripped))
+        except ValueError:
+            pass
+    if '<table' in body.lower():
+        return _table_from_html(body)
+    return None
+
+class _HtmlTableParser(HTMLParser):
+    """HTML断片から <table> ごとの行・セル（テキストと背景色）を取り出す"""
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = []
+        self._table_stack = []
+        self._row = None
+        self._cell = None
+    
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'table':
+            self._table_stack.append([])
+        elif tag == 'tr' and self._table_stack:
+            self._row = {'texts': [], 'colors': []}
+            self._table_stack[-1].append(self._row)
+        elif tag in ('td', 'th') and self._row is not None:
+            self._cell = {'text': [], 'color': _inline_background_color(attrs)}
+        elif tag == 'br' and self._cell is not None:
+            self._cell['text'].append('\n')
+    
+    def handle_endtag(self, tag):
+        if tag in ('td', 'th') and self._cell is not None and self._row is not None:
+            text = ''.join(self._cell['text'])
+            self._row['texts'].append(re.sub(r'[ \t\r\f\v]+', ' ', text).strip())
+            self._row['colors'].append(self._cell['color'])
+            self._cell = None
+        elif tag == 'tr':
+            self._row = None
+        elif tag == 'table' and self._table_stack:
+            self.tables.append(self._table_stack.pop())
+    
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell['text'].append(data)
+
+def _inline_background_color(attrs):
+    """style属性やbgcolor属性から背景色を取得（なければNone）"""
+    style = attrs.get('style') or ''
+    match = re.search(r'background(?:-color)?\s*:\s*([^;]+)', style, re.IGNORECASE)
+    if match:
+        return match.group(1).strip()
+    return attrs.get('bgcolor')
+
+def _table_from_html(body):
+    """HTML内のテーブルのうち、確率（%）を含むデータ行が最も多いものを返す"""
+    parser = _HtmlTableParser()
+    try:
+        parser.feed(body)
+        parser.close()
+    except Exception:
+        return None
+    
+    best = None
+    for rows in parser.tables:
+        rows = [row for row in rows if row['texts']]
+        if len(rows) < 2:
+            continue
+        try:
+            table = _table_from_snapshot({'header': rows[0]['texts'], 'row_sets': [{'selector': 'network', 'rows': rows}]})
+        except Exception:
+            continue
+        prob_rows = sum(1 for row in table['rows'] if any('%' in cell for cell in row))
+        if prob_rows > 0 and (best is None or prob_rows > best[0]):
+            best = (prob_rows, table)
+    return best[1] if best else None
+
+# 金利レンジの列名（例: '300-325'、'3.00 - 3.25'）
+_RATE_RANGE_PATTERN = re.compile(r'^\d+(?:\.\d+)?\s*-\s*\d+(?:\.\d+)?$')
+_DATE_PATTERN = re.compile(r'\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{2,4}|\d{1,2}\s*[A-Za-z]{3}\s*\d{2,4}|[A-Za-z]{3}\s*\d{1,2},?\s*\d{4}')
+
+def _to_float(value):
+    """数値または数値文字列（'88.4%'など）をfloatに変換（変換できなければNone）"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().rstrip('%'))
+        except ValueError:
+            return None
+    return None
+
+def _format_probability(value):
+    """確率を丸めずに表示用文字列へ（例: 88.42137 → '88.4214%'）"""
+    return f"{value:.4f}".rstrip('0').rstrip('.') + '%'
+
+def _table_from_json(payload):
+    """JSON内の「会合日ごとのレコード一覧」から確率テーブルを復元"""
+    for records in _iter_json_lists(payload):
+        if len(records) == 0 or not all(isinstance(record, dict) for record in records):
+            continue
+        # 全レコードで日付形式の値を持つキーを会合日とみなす
+        date_key = next((key for key in records[0]
+                         if all(isinstance(r.get(key), str) and _DATE_PATTERN.search(r.get(key)) for r in records)), None)
+        if date_key is None:
+            continue
+        # 金利レンジの形のキーで、全レコードで0〜100の数値を持つものを確率の列とみなす（id などの数値は除く）
+        buckets = [key for key in records[0]
+                   if key != date_key and _RATE_RANGE_PATTERN.match(str(key).strip())
+                   and all(_to_float(r.get(key)) is not None and 0.0 <= _to_float(r.get(key)) <= 100.0 for r in records)]
+        if len(buckets) < 2:
+            continue
+        
+        # 0〜1の小数かどうかは確率の列だけで判定する
+        values = [[_to_float(record[key]) for key in buckets] for record in records]
+        # 0〜1の小数で届いている場合は%に換算
+        scale = 100.0 if max(max(row) for row in values) <= 1.0 else 1.0
+        bucket_row = ['MEETING DATE'] + [str(key) for key in buckets]
+        rows = [bucket_row] + [
+            [str(record[date_key]).strip()] + [_format_probability(value * scale) for value in row_values]
+            for record, row_values in zip(records, values)
+        ]
+        return {
+            'header': bucket_row,
+            'rows': rows,
+            'cell_colors': [[None, None] + [None] * len(row) for row in rows]
+        }
+    return None
+
+def _iter_json_lists(node):
+    """JSON内のすべてのリストを幅優先で列挙"""
+    queue = [node]
+    while queue:
+        current = queue.pop(0)
+        if isinstance(current, list):
+            yield current
+            queue.extend(item for item in current if isinstance(item, (list, dict)))
+        elif isinstance(current, dict):
+            queue.extend(value for value in current.values() if isinstance(value, (list, dict)))
+
+# FedWatchツールのURL
+FEDWATCH_URL = "https://www.cmegroup.com/ja/markets/interest-rates/cme-fedwatch-tool.html"
+
+class _BrowserSession:
+    """起動したChromiumを保持し、実行・再試行の間で使い回す"""
+    
+    def __init__(self):
+        self._playwright = None
+        self.browser = None
+        self.context = None
+        self.page = None
+        self.request_filter = _RequestFilter(ROUTE_PROFILE)
+        self._state_loaded = False  # 保存状態を読み込んで起動したか
+    
+    def ensure_page(self):
+        """ページがなければブラウザを起動してページを作成"""
+        if self.page is None or self.page.is_closed():
+            self.relaunch()
+        return self.page
+    
+    def relaunch(self):
+        """ブラウザを閉じて起動し直す"""
+        self.close_browser()
+        if self._playwright is None:
+            from playwright.sync_api import sync_playwright
+            self._playwright = sync_playwright().start()
+        self._state_loaded = bool(BROWSER_PROFILE_DIR) or _usable_storage_state() is not None
+        # Chromiumブラウザを起動
+        self.browser, self.context, self.page = _launch_browser(self._playwright, self.request_filter)
+    
+    def save_storage_state(self):
+        """空の状態から取得に成功した場合、Cookieなどを保存して次回以降に再利用する
+        
+        保存済みの状態で起動した場合は上書きしない（有効期限が延びないように）。
+        """
+        if BROWSER_PROFILE_DIR or not STORAGE_STATE_FILE or self._state_loaded or self.context is None:
+            return
+        try:
+            self.context.storage_state(path=STORAGE_STATE_FILE)
+            self._state_loaded = True
+            print(f"ブラウザ状態を保存しました: {STORAGE_STATE_FILE}")
+        except Exception as e:
+            print(f"ブラウザ状態の保存でエラー（続行します）: {e}")
+    
+    def discard_storage_state(self):
+        """取得に失敗したときに保存状態を破棄し、次の起動を空の状態から始める"""
+        if BROWSER_PROFILE_DIR:
+            if self.context is not None:
                 try:
-                    # ページに遷移
-                    _navigate_to_page(page, url, attempt)
-                    
-                    # iframeを探す
-                    frame = _find_iframe(page)
-                    
-                    # iframe内のデータが読み込まれるまで待つ（元のコードと同じ）
-                    print("iframe内のデータを待機中...")
-                    time.sleep(WAIT_AFTER_IFRAME_LOAD)
-                    
-                    # Probabilitiesをクリック
-                    _click_probabilities(frame)
-                    
-                    # テーブルが表示されるまで待つ（元のコードと同じ）
-                    print("テーブルの読み込みを待機中...")
-                    time.sleep(5)  # 元のコードと同じ
-                    
-                    # テーブルを探す
-                    _find_table(frame)  # テーブルが存在することを確認
-                    
-                    # より長い待機時間を設定（元のコードと同じ）
-                    time.sleep(WAIT_FOR_TABLE_DATA)
-                    
-                    # ヘッダー行を取得
-                    header_row = _extract_table_header(frame)
-                    
-                    # データ行と色情報を取得
-                    data_rows, cell_colors = _extract_table_rows(frame, header_row)
-                    
-                    browser.close()
-                    
-                    # ヘッダーとデータ、色情報を返す
-                    return {
-                        'header': header_row if header_row else [],
-                        'rows': data_rows,
-                        'cell_colors': cell_colors
-                    }
-                    
-                except Exception as e:
-                    print(f"スクレイピングエラー（chromium, 試行 {attempt + 1}/{MAX_RETRIES}）: {e}")
-                    try:
-                        browser.close()
-                    except Exception:
-                        pass
-                    
-                    if attempt < MAX_RETRIES - 1:
-                        print(f"{RETRY_DELAY}秒待機して再試行します...")
-                        time.sleep(RETRY_DELAY)
-                        continue
-                    
-                    raise Exception(f"スクレイピングに失敗しました（chromium, {MAX_RETRIES}回試行）: {e}")
-                    
+                    self.context.clear_cookies()
+                except Exception:
+                    pass
+        elif STORAGE_STATE_FILE and os.path.exists(STORAGE_STATE_FILE):
+            print("保存済みのブラウザ状態を破棄します")
+            _discard_storage_state_file()
+        self._state_loaded = False
+    
+    def close_browser(self):
+        """ブラウザだけを閉じる（Playwright本体は残す）"""
+        for target in (self.context, self.browser):
+            if target is not None:
+                try:
+                    target.close()
+                except Exception:
+                    pass
+        self.browser = None
+        self.context = None
+        self.page = None
+    
+    def close(self):
+        """ブラウザとPlaywright本体を終了"""
+        self.close_browser()
+        if self._playwright is not None:
+            try:
+                self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+
+def _backoff_delay(retry_index, base=STAGE_BACKOFF_BASE, cap=STAGE_BACKOFF_MAX):
+    """指数バックオフの待機時間（秒）。半分は固定、残り半分はランダムにして再試行の集中を避ける"""
+    delay = min(cap, base * (2 ** retry_index))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _run_stage(name, fn):
+    """名前付きの段階を実行し、失敗したらバックオフを挟んでその段階だけを再試行"""
+    retries = STAGE_RETRIES.get(name, 0)
+    for retry in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            with _trace.stage(name):
+                result = fn()
+            print(f"段階 '{name}' 完了（{time.perf_counter() - started:.2f}秒）")
+            return result
         except Exception as e:
-            # 外側の例外処理（ブラウザ起動失敗など）
-            print(f"ブラウザ起動エラー（chromium, 試行 {attempt + 1}/{MAX_RETRIES}）: {e}")
-            if attempt < MAX_RETRIES - 1:
-                print(f"{RETRY_DELAY}秒待機して再試行します...")
-                time.sleep(RETRY_DELAY)
-                continue
-            
-            raise Exception(f"スクレイピングに失敗しました（chromium, {MAX_RETRIES}回試行）: {e}")
+            if retry >= retries:
+                raise Exception(f"段階 '{name}' で失敗しました: {e}")
+            delay = _backoff_delay(retry)
+            _trace.count("stage_retries", kind=name)
+            print(f"段階 '{name}' でエラー（{delay:.1f}秒後にこの段階だけ再試行 {retry + 1}/{retries}）: {e}")
+            time.sleep(delay)
+
+def _scrape_on_page(page, attempt, reload=False):
+    """起動済みのページでFedWatchのテーブルを取得（reload=True なら再読み込みで取り直す）
+    
+    navigate → find_iframe → click_tab → find_table → extract の段階ごとに再試行する。
+    """
+    # 通信レスポンスの記録はページ遷移前に開始する
+    capture = _ResponseCapture(page) if CAPTURE_MODE == "network" else None
+    
+    def open_frame():
+        # iframeを探し、iframe内のデータが読み込まれるまで待つ
+        frame = _find_iframe(page)
+        print("iframe内のデータを待機中...")
+        _wait_for_frame_idle(frame, "iframeの通信完了")
+        return frame
+    
+    def click_tab():
+        # Probabilitiesをクリックし、タブが切り替わってテーブルの通信が終わるまで待つ
+        clicked = _click_probabilities(frame)
+        print("テーブルの読み込みを待機中...")
+        if not _wait_for_tab_active(frame) and not clicked:
+            # クリックできず、選択状態でもない場合は、この段階を再試行する
+            raise Exception("Probabilitiesタブをクリックできず、選択状態にもなっていません")
+        _wait_for_frame_idle(frame, "テーブルの通信完了")
     
-    raise Exception("スクレイピングに失敗しました（すべての試行が失敗）")
+    def find_table():
+        # テーブルが存在することを確認し、行数とセルの内容が安定するまで待つ
+        _find_table(frame)
+        _wait_for_table_stable(frame)
+    
+    try:
+        # ページに遷移
+        _run_stage("navigate", lambda: _navigate_to_page(page, FEDWATCH_URL, attempt, reload=reload))
+        frame = _run_stage("find_iframe", open_frame)
+        _run_stage("click_tab", click_tab)
+        
+        # 通信レスポンスから取得できれば、DOMの探索とレンダリング待ちを省略
+        if capture is not None:
+            table_data = capture.extract_table()
+            if table_data:
+                return table_data
+            print("通信レスポンスからテーブルを取得できませんでした（DOMから取得します）")
+        
+        _run_stage("find_table", find_table)
+        
+        # ヘッダー・データ行・色情報を取得
+        return _run_stage("extract", lambda: _extract_table(frame))
+    finally:
+        if capture is not None:
+            capture.detach()
 
-# --- 3. スプレッドシートへ書き込み（前回値比較 + 矢印 + 色情報も適用） ---
-def update_sheet(table_data):
-    spreadsheet = gc.open(SPREADSHEET_NAME)
-    sh = spreadsheet.sheet1
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+def scrape_fed_data(session=None):
+    """CME FedWatchサイトからデータをスクレイピング
+    
+    session を渡すと起動済みのブラウザを使い回す（常駐モード）。
+    失敗した場合は、まずページの再読み込みで再試行し、それでも失敗したらブラウザを起動し直す。
+    """
+    own_session = session is None
+    if own_session:
+        session = _BrowserSession()
     
-    # 前回値シートの準備
-    previous_sheet_name = PREVIOUS_SHEET_NAME
     try:
-        previous_sheet = spreadsheet.worksheet(previous_sheet_name)
-        print(f"前回値シート '{previous_sheet_name}' が見つかりました")
-    except gspread.exceptions.WorksheetNotFound:
-        # 前回値シートが存在しない場合は作成
-        previous_sheet = spreadsheet.add_worksheet(title=previous_sheet_name, rows=100, cols=20)
-        print(f"前回値シート '{previous_sheet_name}' を作成しました")
-    
-    # 前回値を読み込む
-    previous_data = None
-    previous_datetime = None  # 前回の取得日時
+        last_error = None
+        for attempt in range(MAX_RETRIES):
+            # 1回目: 通常の遷移 / 2回目: 同じページを再読み込み（安価な再試行） / 3回目以降: ブラウザを再起動
+            reload = attempt == 1 and session.page is not None and not session.page.is_closed()
+            try:
+                if attempt > 0:
+                    _trace.count("scrape_retries", kind="reload" if reload else "relaunch")
+                if attempt > 0 and not reload:
+                    print(f"{RETRY_DELAY}秒待機してブラウザを再起動します...")
+                    time.sleep(RETRY_DELAY)
+                    # 保存状態が原因の可能性もあるため、空の状態から起動し直す
+                    session.discard_storage_state()
+                    session.relaunch()
+                page = session.ensure_page()
+                table_data = _scrape_on_page(page, attempt, reload=reload)
+                _trace.count("cells_extracted", sum(len(row) for row in table_data['rows']))
+                session.save_storage_state()
+                return table_data
+            except Exception as e:
+                last_error = e
+                print(f"スクレイピングエラー（chromium, 試行 {attempt + 1}/{MAX_RETRIES}）: {e}")
+        
+        raise Exception(f"スクレイピングに失敗しました（chromium, {MAX_RETRIES}回試行）: {last_error}")
+    finally:
+        session.request_filter.log_and_reset()
+        _selector_cache.save()
+        if own_session:
+            session.close()
+
+# --- 複数ビューの同時取得（playwright.async_api） ---
+
+async def _poll_until_async(check_fn, timeout_ms, interval_ms=TABLE_POLL_INTERVAL):
+    """check_fn（コルーチン関数）が True を返すまでポーリング（上限を超えたら例外）"""
+    deadline = time.perf_counter() + timeout_ms / 1000
+    while True:
+        if await check_fn():
+            return
+        if time.perf_counter() >= deadline:
+            raise TimeoutError(f"{timeout_ms}ms以内に条件を満たしませんでした")
+        await asyncio.sleep(interval_ms / 1000)
+
+async def _wait_for_async(label, awaitable):
+    """条件待機を実行し、かかった時間をログに出す（上限に達した場合は警告して続行）"""
+    started = time.perf_counter()
     try:
-        previous_values = previous_sheet.get_all_values()
-        if len(previous_values) > 1:  # ヘッダー行以外にデータがある場合
-            # ヘッダー行を除いて、データ部分のみ取得
-            previous_data = previous_values[1:] if len(previous_values) > 1 else []
-            print(f"前回値データを{len(previous_data)}行読み込みました")
-            
-            # 前回の取得日時を取得（2行目のA列、つまりprevious_values[1][0]）
-            if len(previous_values) > 1 and len(previous_values[1]) > 0:
-                previous_datetime = previous_values[1][0]
-                print(f"前回の取得日時: {previous_datetime}")
+        await awaitable
+        print(f"待機完了: {label}（{time.perf_counter() - started:.2f}秒）")
     except Exception as e:
-        print(f"前回値の読み込みでエラー: {e}")
-        previous_data = None
-    
-    # 列番号を文字列に変換するヘルパー関数
-    def col_num_to_letter(n):
-        """列番号（1始まり）を列文字（A, B, C, ...）に変換"""
-        result = ""
-        while n > 0:
-            n -= 1
-            result = chr(65 + (n % 26)) + result
-            n //= 26
-        return result
-    
-    # 既存データを読み込む（履歴として保持するため）
-    existing_data = []
-    existing_datetime_from_history = None  # 既存データ（履歴）から取得した最新の取得日時
-    existing_data_range = None  # 既存データの範囲（色込みで移動するため）
+        print(f"警告: {label}の待機が上限に達しました（{time.perf_counter() - started:.2f}秒、続行します）: {e}")
+
+async def _find_frame_async(page):
+    """quikstrikeのiframe（Frame本体）を検索"""
+    for selector in _selector_cache.ordered("find_iframe", IFRAME_SELECTORS, IFRAME_FALLBACK_SELECTORS):
+        handle = await page.query_selector(selector)
+        if handle is not None:
+            frame = await handle.content_frame()
+            if frame is not None:
+                _selector_cache.record("find_iframe", selector, hit=True)
+                if MEMORY_PROFILE == "lean" and selector not in IFRAME_FALLBACK_SELECTORS:
+                    await _close_other_frames_async(page, frame)
+                return frame
+        _selector_cache.record("find_iframe", selector, hit=False)
+    raise Exception("iframeが見つかりませんでした")
+
+async def _click_tab_async(frame, view):
+    """ビュー名のタブをクリック（見つからなければ既に選択されているとみなす）"""
+    step = f"click_tab:{view}"
+    for selector in _selector_cache.ordered(step, _tab_selectors(view)):
+        try:
+            tab = frame.locator(selector).first
+            if await tab.is_visible():
+                await tab.click(timeout=ELEMENT_WAIT_TIMEOUT)
+                _selector_cache.record(step, selector, hit=True)
+                return True
+        except Exception:
+            pass
+        _selector_cache.record(step, selector, hit=False)
+    print(f"[{view}] 警告: タブが見つかりませんでした。既に選択されている可能性があります。")
+    return False
+
+async def _scrape_view_async(context, view):
+    """新しいページで1つのビューを開き、テーブルを取得"""
+    page = await context.new_page()
     try:
-        existing_data = sh.get_all_values()
-        if existing_data:
-            print(f"既存データを{len(existing_data)}行読み込みました（履歴として保持）")
-            # 既存データの1行目から取得日時を抽出
-            if len(existing_data) > 0 and existing_data[0]:
-                first_row_text = str(existing_data[0][0]) if existing_data[0] else ""
-                # 「取得日時: YYYY-MM-DD HH:MM」の形式から取得日時を抽出
-                datetime_match = re.search(r'取得日時:\s*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2})', first_row_text)
-                if datetime_match:
-                    existing_datetime_from_history = datetime_match.group(1)
-                    print(f"既存データ（履歴）から最新の取得日時を抽出: {existing_datetime_from_history}")
-            
-            # 既存データの範囲を保存（色込みで移動するため）
-            num_existing_rows = len(existing_data)
-            num_existing_cols = max(len(row) for row in existing_data) if existing_data else 0
-            if num_existing_rows > 0 and num_existing_cols > 0:
-                existing_data_range = {
-                    'start_row': 1,
-                    'end_row': num_existing_rows,
-                    'start_col': 1,
-                    'end_col': num_existing_cols
-                }
-                print(f"既存データの範囲: {num_existing_rows}行 × {num_existing_cols}列")
-    except Exception as e:
-        print(f"既存データの読み込みでエラー（新規作成として続行）: {e}")
-        existing_data = []
+        print(f"[{view}] サイトへアクセス中...")
+        await page.goto(FEDWATCH_URL, wait_until="domcontentloaded", timeout=PAGE_LOAD_TIMEOUT)
+        await _wait_for_async(
+            f"[{view}] iframeの追加",
+            page.wait_for_selector("iframe[src*='quikstrike'], iframe[src*='fedwatch']", state="attached", timeout=IFRAME_ATTACH_TIMEOUT)
+        )
+        frame = await _find_frame_async(page)
+        await _wait_for_async(f"[{view}] iframeの通信完了", frame.wait_for_load_state("networkidle", timeout=FRAME_NETWORK_IDLE_TIMEOUT))
+        
+        await _click_tab_async(frame, view)
+        
+        async def tab_is_active():
+            return await frame.evaluate(_TAB_ACTIVE_JS, view)
+        await _wait_for_async(f"[{view}] タブの選択", _poll_until_async(tab_is_active, TAB_ACTIVE_TIMEOUT, interval_ms=200))
+        await _wait_for_async(f"[{view}] テーブルの通信完了", frame.wait_for_load_state("networkidle", timeout=FRAME_NETWORK_IDLE_TIMEOUT))
+        
+        # 行数とセルの内容が2回のポーリングで変化しなくなるまで待つ
+        last_signature = [None]
+        async def table_is_stable():
+            signature = await frame.evaluate(_TABLE_SIGNATURE_JS)
+            stable = signature['rows'] > 0 and signature['has_data'] and signature == last_signature[0]
+            last_signature[0] = signature
+            return stable
+        await _wait_for_async(f"[{view}] テーブルデータの安定", _poll_until_async(table_is_stable, TABLE_STABLE_TIMEOUT))
+        
+        table = _table_from_snapshot(await frame.evaluate(_TABLE_SNAPSHOT_JS))
+        print(f"[{view}] データ行を{len(table['rows'])}行取得しました")
+        return table
+    finally:
+        await page.close()
+
+async def _scrape_view_with_retries(context, view, semaphore):
+    """同時実行数の上限を守りながら、1つのビューを再試行付きで取得"""
+    async with semaphore:
+        last_error = None
+        for attempt in range(MAX_RETRIES):
+            try:
+                return await _scrape_view_async(context, view)
+            except Exception as e:
+                last_error = e
+                print(f"[{view}] スクレイピングエラー（試行 {attempt + 1}/{MAX_RETRIES}）: {e}")
+                if attempt < MAX_RETRIES - 1:
+                    await asyncio.sleep(_backoff_delay(attempt))
+        raise Exception(f"[{view}] スクレイピングに失敗しました（{MAX_RETRIES}回試行）: {last_error}")
+
+async def _scrape_views_async(views, max_concurrency):
+    """1つのブラウザコンテキストで複数のビューを同時に取得"""
+    request_filter = _RequestFilter(ROUTE_PROFILE)
+    launch_args, context_options = _browser_options()
+    storage_state = _usable_storage_state()
+    if storage_state:
+        context_options['storage_state'] = storage_state
     
-    # 数値を抽出する関数（%記号や矢印を除去）
-    def extract_number(value):
-        """セルから数値を抽出（例: '88.4% ↑' → 88.4）"""
-        if not value or not isinstance(value, str):
-            return None
+    from playwright.async_api import async_playwright
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=_headless(), args=launch_args)
         try:
-            # %記号と矢印を除去して数値を抽出
-            match = re.search(r'(\d+\.?\d*)', value.replace('%', '').replace('↑', '').replace('↓', '').replace('→', '').strip())
-            if match:
-                return float(match.group(1))
-        except:
-            pass
-        return None
+            context = await browser.new_context(**context_options)
+            if request_filter.rules:
+                await context.route("**/*", request_filter.handle_async)
+            har_options = _har_options()
+            if har_options:
+                await context.route_from_har(HAR_FILE, **har_options)
+            semaphore = asyncio.Semaphore(max(1, max_concurrency))
+            results = await asyncio.gather(
+                *(_scrape_view_with_retries(context, view, semaphore) for view in views),
+                return_exceptions=True
+            )
+        finally:
+            await browser.close()
+    request_filter.log_and_reset()
+    _selector_cache.save()
+    
+    tables = {}
+    for view, result in zip(views, results):
+        if isinstance(result, Exception):
+            print(f"エラー: {result}")
+        else:
+            tables[view] = result
+    if not tables:
+        raise Exception("すべてのビューの取得に失敗しました")
+    return tables
+
+def scrape_fed_views(views=None, max_concurrency=None):
+    """複数のビュー（quikstrike内のタブ）を同時に取得し、{ビュー名: テーブル} を返す
+    
+    各テーブルは scrape_fed_data と同じ {'header', 'rows', 'cell_colors'} 形式。
+    取得に失敗したビューは結果に含めない（すべて失敗した場合は例外）。
+    """
+    views = list(views or SCRAPE_VIEWS)
+    max_concurrency = max_concurrency or VIEW_CONCURRENCY
+    print(f"{len(views)}個のビューを同時に取得します（同時実行数: {max_concurrency}）: {', '.join(views)}")
+    started = time.perf_counter()
+    tables = asyncio.run(_scrape_views_async(views, max_concurrency))
+    print(f"{len(tables)}/{len(views)}個のビューを取得しました（{time.perf_counter() - started:.1f}秒）")
+    return tables
+
+# --- ライブモード（表の変化をブラウザから受け取る） ---
+# iframe内にMutationObserverを設置し、変化したセル（テキストと背景色）だけを Python に送る
+# 送り先は page.expose_binding で公開した関数。Python側は最新のスナップショットに差分を反映する
+
+LIVE_BINDING_NAME = "__cmeTableDelta"
+
+_LIVE_OBSERVER_JS = """
+(bindingName) => {
+    const readSnapshot = """ + _TABLE_SNAPSHOT_JS.strip() + """;
+    // 行数・列数・ヘッダーが変わったときは差分ではなく全体を送る
+    const shape = (snapshot) => JSON.stringify([
+        snapshot.header,
+        snapshot.row_sets.map(set => set.selector + ':' + set.rows.map(row => row.texts.length).join(','))
+    ]);
+    if (window.__cmeLiveObserver) {
+        window.__cmeLiveObserver.disconnect();
+    }
+    let last = readSnapshot();
+    let timer = null;
+    const sendChanges = () => {
+        timer = null;
+        const current = readSnapshot();
+        if (shape(current) !== shape(last)) {
+            last = current;
+            window[bindingName]({full: current});
+            return;
+        }
+        const changes = [];
+        current.row_sets.forEach((set, s) => set.rows.forEach((row, r) => row.texts.forEach((text, c) => {
+            const previous = last.row_sets[s].rows[r];
+            if (previous.texts[c] !== text || previous.colors[c] !== row.colors[c]) {
+                changes.push([s, r, c, text, row.colors[c]]);
+            }
+        })));
+        last = current;
+        if (changes.length > 0) {
+            window[bindingName]({changes: changes});
+        }
+    };
+    // 連続した変更は200msまとめてから比較する
+    const observer = new MutationObserver(() => {
+        if (timer === null) {
+            timer = setTimeout(sendChanges, 200);
+        }
+    });
+    observer.observe(document.body, {
+        subtree: true, childList: true, characterData: true,
+        attributes: true, attributeFilter: ['style', 'class']
+    });
+    window.__cmeLiveObserver = observer;
+    return last;
+}
+"""
+
+class _LiveTable:
+    """ブラウザから届いた差分を反映しながら、最新のスナップショットを保持する"""
+    
+    def __init__(self, snapshot, frame=None):
+        self.snapshot = snapshot
+        self.frame = frame
+        self.dirty = False  # 最後に書き込んでから変化があったか
+    
+    def frame_detached(self):
+        """監視しているiframeがなくなったか（FrameLocatorの場合は判定できないのでFalse）"""
+        is_detached = getattr(self.frame, 'is_detached', None)
+        return bool(is_detached and is_detached())
+    
+    def handle_delta(self, source, payload):
+        """page.expose_binding から呼ばれる（変化したセルの一覧、または全体）"""
+        if 'full' in payload:
+            self.snapshot = payload['full']
+            _trace.count("live_full_updates")
+        else:
+            row_sets = self.snapshot['row_sets']
+            for set_index, row_index, col_index, text, color in payload['changes']:
+                row = row_sets[set_index]['rows'][row_index]
+                row['texts'][col_index] = text
+                row['colors'][col_index] = color
+            _trace.count("live_cells_changed", len(payload['changes']))
+        self.dirty = True
+    
+    def table(self):
+        """現在の内容を {'header', 'rows', 'cell_colors'} 形式で返す"""
+        return _table_from_snapshot(self.snapshot)
+
+def _start_live_table(page):
+    """Probabilitiesを表示しているページに監視を設置し、_LiveTable を返す"""
+    live = _LiveTable(None, _find_iframe(page))
+    page.expose_binding(LIVE_BINDING_NAME, live.handle_delta)
+    live.snapshot = _evaluate_in_frame(live.frame, _LIVE_OBSERVER_JS, LIVE_BINDING_NAME)
+    return live
+
+# --- 3. スプレッドシートへ書き込み（前回値比較 + 矢印 + 色情報も適用） ---
+def update_sheet(table_data, prefetched=None, spreadsheet_name=SPREADSHEET_NAME):
+    """スプレッドシートに書き込む
+    
+    prefetched に prefetch_sheet_state の結果を渡すと、読み込みを省いてすぐに書き込む。
+    前回から変化がなく書き込みを省略した場合は False を返す。
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    return write_snapshots([(table_data, now)], prefetched, spreadsheet_name) > 0
+
+def write_snapshots(snapshots, prefetched=None, spreadsheet_name=SPREADSHEET_NAME):
+    """取得結果 [(table_data, 取得日時 'YYYY-MM-DD HH:MM')] を古い順に、1回のbatchUpdateで書き込む
+    
+    キャッシュしたIDが無効なら（状態の読み込みで見つからない場合も）、キャッシュを破棄して1回だけやり直す。
+    書き込んだ（前回から変化があった）件数を返す。
+    prefetched は書き込み後の状態に更新される（空の辞書を渡すと、読み込んだ状態がそこに入る）。
+    """
+    state = prefetched if prefetched is not None else {}
+    with _trace.stage("sheets_write"):
+        try:
+            if not state:
+                state.update(prefetch_sheet_state(spreadsheet_name))
+            return _update_sheet_once(snapshots, state)
+        except Exception as e:
+            if not _is_not_found_error(e):
+                raise
+            # シートの削除・作り直しなどでキャッシュが古くなっている
+            _invalidate_spreadsheet_cache(spreadsheet_name)
+            print(f"スプレッドシートまたはシートが見つかりません（メタデータを取得し直して再試行します）: {e}")
+            state.clear()
+            state.update(prefetch_sheet_state(spreadsheet_name))
+            return _update_sheet_once(snapshots, state)
+
+def prefetch_sheet_state(spreadsheet_name=SPREADSHEET_NAME):
+    """書き込みの前に必要な情報（シート情報・前回値・履歴の先頭）を読み込む
+    
+    スクレイピングの結果には依存しないため、ブラウザの取得と並行して実行できる（_run_once_traced）。
+    """
+    with _trace.stage("sheets_prefetch"):
+        spreadsheet_id, sheets = _resolve_spreadsheet(spreadsheet_name)
+        # 1枚目のシートに履歴を書き込む
+        sh = min(sheets.values(), key=lambda sheet: sheet['index'])
+        
+        # 前回値シートの準備
+        previous_sheet_name = PREVIOUS_SHEET_NAME
+        previous_sheet = sheets.get(previous_sheet_name)
+        if previous_sheet is not None:
+            print(f"前回値シート '{previous_sheet_name}' が見つかりました")
+        else:
+            # 前回値シートが存在しない場合は作成
+            previous_sheet = _add_sheet(spreadsheet_id, sheets, previous_sheet_name, rows=100, cols=20)
+            print(f"前回値シート '{previous_sheet_name}' を作成しました")
+        
+        # 前回値シート全体と、履歴シートの先頭セル（最新の取得日時）だけを1回でまとめて読み込む
+        # 履歴シート全体は読まない（実行のたびに増え続けるため）
+        # 履歴の上限がある場合はA列を読み、ブロックの区切りを調べる（上限までしか増えない）
+        previous_values = []
+        history_head = []
+        history_range = 'A:A' if HISTORY_KEEP_SNAPSHOTS > 0 else 'A1'
+        try:
+            value_ranges = _execute(_get_sheets_service().spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=[_a1_range(previous_sheet['title']), _a1_range(sh['title'], history_range)]
+            ), "values.batchGet").get('valueRanges', [])
+            previous_values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+            history_head = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+        except Exception as e:
+            if _is_not_found_error(e):
+                raise
+            print(f"前回値・履歴の読み込みでエラー（新規作成として続行）: {e}")
+    
+    return {
+        'spreadsheet_name': spreadsheet_name,
+        'spreadsheet_id': spreadsheet_id,
+        'sheets': sheets,
+        'history_sheet': sh,
+        'previous_sheet': previous_sheet,
+        'previous_values': previous_values,
+        'history_head': history_head
+    }
+
+def _update_sheet_once(snapshots, state):
+    """取得結果を1回のbatchUpdateで書き込み、書き込んだ件数を返す
+    
+    シート情報（行数・列数）・前回値・履歴のA列はコピーに対して組み立て、batchUpdate が成功してから
+    state とメタデータキャッシュに反映する（失敗したときに、実際より大きい行数・列数が残らないように）。
+    """
+    service = _get_sheets_service()
+    spreadsheet_id = state['spreadsheet_id']
+    planned_sheets = {title: dict(sheet) for title, sheet in state['sheets'].items()}
+    plan = dict(state,
+                sheets=planned_sheets,
+                history_sheet=planned_sheets[state['history_sheet']['title']],
+                previous_sheet=planned_sheets[state['previous_sheet']['title']],
+                history_head=list(state['history_head']))
+    requests = []
+    archive_lines = {}
+    
+    # 上限を超えた古い履歴をアーカイブへ移す（行の削除も同じbatchUpdateで行う）
+    history_head = plan['history_head']
+    if HISTORY_KEEP_SNAPSHOTS > 0 and history_head and history_head[0] and str(history_head[0][0]).strip():
+        archive_requests, archive_lines = _plan_history_archive(
+            service, spreadsheet_id, plan['sheets'], plan['history_sheet'], history_head)
+        requests.extend(archive_requests)
+    
+    # 1件ずつ、直前の取得結果と比較して書き込みを組み立てる（plan は書き込み後の状態に更新される）
+    written = 0
+    for table_data, now in snapshots:
+        snapshot_requests, changed = _plan_snapshot(table_data, now, plan)
+        requests.extend(snapshot_requests)
+        written += changed
+    if written > 0:
+        requests.extend(_previous_sheet_requests(plan['previous_sheet'], plan['previous_values']))
+    
+    if requests:
+        _execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'requests': requests}
+        ), "spreadsheets.batchUpdate")
+        # 履歴シートから削除できた場合だけファイルに追記する（失敗して再試行しても二重に追記しない）
+        _append_history_archive_files(archive_lines)
+        print(f"スプレッドシート '{state['spreadsheet_name']}' を1回のbatchUpdateで更新しました"
+              f"（{len(snapshots)}回分、{len(requests)}件の操作）")
+    
+    # 書き込めたので、行数・列数の変化をキャッシュに、前回値と履歴のA列を state に反映
+    with _sheets_cache_lock:
+        for title, sheet in planned_sheets.items():
+            state['sheets'].setdefault(title, {}).update(sheet)
+        if requests:
+            _save_sheets_cache()
+    state['previous_values'] = plan['previous_values']
+    state['history_head'] = plan['history_head']
+    if requests:
+        print("スプレッドシートへの書き込み完了")
+    return written
+
+def _plan_snapshot(table_data, now, state):
+    """1回分の取得結果を書き込むリクエストを組み立て、(リクエスト, 変化があったか) を返す
+    
+    state の前回値と履歴の先頭を、書き込み後の内容に更新する（続けて次の取得結果を組み立てられるように）。
+    """
+    sh = state['history_sheet']
+    previous_values = state['previous_values']
+    history_head = state['history_head']
+    
+    # 前回値を取り出す
+    previous_data = None
+    previous_datetime = None  # 前回の取得日時
+    if len(previous_values) > 1:  # ヘッダー行以外にデータがある場合
+        # ヘッダー行を除いて、データ部分のみ取得
+        previous_data = previous_values[1:]
+        print(f"前回値データを{len(previous_data)}行読み込みました")
+        
+        # 前回の取得日時を取得（2行目のA列、つまりprevious_values[1][0]）
+        if len(previous_values[1]) > 0:
+            previous_datetime = previous_values[1][0]
+            print(f"前回の取得日時: {previous_datetime}")
+    
+    # 前回と内容（値と色）が同じなら、履歴を増やさずに終了する
+    snapshot_hash = _snapshot_hash(table_data)
+    if UNCHANGED_POLICY != "write" and snapshot_hash == _stored_snapshot_hash(previous_values):
+        print(f"前回（{previous_datetime}）から変化がありません")
+        # 最新ブロックの2行目（空行、または前回の確認時刻）に記録する
+        # 2行目が空行になるのはヘッダーがある表だけ（ヘッダーがない表では2行目がデータ行なので記録しない）
+        # A列を1行目しか読まない場合（CME_HISTORY_KEEP=0）もあるため、シートの内容ではなく表から判断する
+        if UNCHANGED_POLICY == "marker" and history_head and table_data['header']:
+            print(f"最新データに変化なしの確認時刻を記録します: {now}")
+            marker = f"{UNCHANGED_MARKER_LABEL} {now}"
+            if len(history_head) > 1:
+                history_head[1] = [marker]
+            else:
+                history_head.append([marker])
+            return [_update_cells_request(sh['sheetId'], 1, [[marker]])], False
+        return [], False
+    
+    # 履歴の先頭セルから最新の取得日時を取り出す
+    first_row_text = str(history_head[0][0]) if history_head and history_head[0] else ""
+    has_history = bool(first_row_text.strip())  # 既存データ（履歴）があれば下に移動する
+    existing_datetime_from_history = None  # 既存データ（履歴）から取得した最新の取得日時
+    if has_history:
+        print("既存データ（履歴）があります（下に移動して保持します）")
+        # 「取得日時: YYYY-MM-DD HH:MM」の形式から取得日時を抽出
+        datetime_match = _HISTORY_DATETIME_PATTERN.search(first_row_text)
+        if datetime_match:
+            existing_datetime_from_history = datetime_match.group(1)
+            print(f"既存データ（履歴）から最新の取得日時を抽出: {existing_datetime_from_history}")
     
     # 現在のデータと前回値を比較して、矢印を決定
     all_data = []
@@ -444,227 +2159,902 @@ def update_sheet(table_data):
         empty_row = [''] * num_cols
         all_data.append(empty_row)
     
-    # データ行を書き込む（前回値と比較して矢印を追加）
+    # データ行を書き込む（前回値と会合日・金利レンジごとに比較して矢印を追加）
+    data_start = len(all_data)
     if table_data['rows']:
-        
-        for row_idx, row in enumerate(table_data['rows']):
-            row_data = []  # 取得日時列と空列は削除
-            
-            for col_idx, current_val in enumerate(row):
-                # 確率値（%を含む）の場合のみ矢印を付ける
-                # 会合日（日付形式）やヘッダーには矢印を付けない
-                arrow = ""
-                change_text = ""  # 初期化
-                
-                # 確率値かどうかを判定（%記号を含み、数値であること）
-                if current_val and '%' in str(current_val):
-                    # 前回値と比較
-                    # 列は取得日時列と空列が削除されたので、そのまま col_idx を使用
-                    previous_val = None
-                    if previous_data and row_idx < len(previous_data) and col_idx < len(previous_data[row_idx]):
-                        # 前回値シートの構造: [取得日時, 空列, データ...] なので col_idx + 2 でアクセス
-                        previous_val_str = previous_data[row_idx][col_idx + 2] if len(previous_data[row_idx]) > col_idx + 2 else None
-                        previous_val = extract_number(previous_val_str)
-                    
-                    current_num = extract_number(current_val)
-                    
-                    # 矢印と増減率を決定
-                    if current_num is not None and previous_val is not None:
-                        diff = current_num - previous_val
-                        if abs(diff) > MIN_CHANGE_THRESHOLD:  # 閾値以上の変化がある場合
-                            if diff > 0:
-                                arrow = " ↑"
-                                change_text = f" +{diff:.1f}%"
-                            else:
-                                arrow = " ↓"
-                                change_text = f" {diff:.1f}%"  # 負の値なので"-"は自動で付く
-                        else:
-                            arrow = " →"
-                            change_text = " ±0.0%"
-                    # 前回値がない場合（初回実行など）は矢印・増減率なし
-                
-                # セルの値に矢印と増減率を追加（確率値の場合のみ）
-                if current_val:
-                    cell_value = current_val + arrow + change_text
-                else:
-                    cell_value = ""
-                row_data.append(cell_value)
-            
-            all_data.append(row_data)
-        
-        print(f"データ行を{len(all_data) - 2}行準備しました（前回値と比較済み）")
+        # 前回値シートの構造は [取得日時, 空列, データ...] なので先頭2列を除いて比較する
+        previous_rows = [row[2:] for row in previous_data] if previous_data else []
+        all_data.extend(_compare_tables(table_data['rows'], previous_rows))
+        print(f"データ行を{len(all_data) - data_start}行準備しました（前回値と比較済み）")
     
-    # 既存データがある場合、まず既存データを色込みで下に移動
-    if existing_data_range and len(existing_data) > 0:
-        try:
-            spreadsheet_id = spreadsheet.id
-            service = build('sheets', 'v4', credentials=creds)
-            
-            # シートIDを取得
-            sheet_name = sh.title
-            spreadsheet_metadata = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheet_id = None
-            for sheet in spreadsheet_metadata.get('sheets', []):
-                if sheet['properties']['title'] == sheet_name:
-                    sheet_id = sheet['properties']['sheetId']
-                    break
-            
-            if sheet_id is None:
-                raise Exception(f"シート '{sheet_name}' のIDを取得できませんでした")
-            
-            # 最新データの行数を計算
-            new_data_rows = len(all_data)
-            # 既存データを移動する先の行番号（最新データ + 区切り線の後）
-            destination_start_row = new_data_rows + 2  # 区切り線を含む
-            
-            # 既存データの範囲
-            source_start_row = existing_data_range['start_row']
-            source_end_row = existing_data_range['end_row']
-            source_start_col = existing_data_range['start_col']
-            source_end_col = existing_data_range['end_col']
-            
-            # 既存データを下に移動（色込みでカット&ペースト）
-            cut_paste_request = {
-                'cutPaste': {
-                    'source': {
-                        'sheetId': sheet_id,
-                        'startRowIndex': source_start_row - 1,  # 0始まりに変換
-                        'endRowIndex': source_end_row,
-                        'startColumnIndex': source_start_col - 1,  # 0始まりに変換
-                        'endColumnIndex': source_end_col
-                    },
-                    'destination': {
-                        'sheetId': sheet_id,
-                        'rowIndex': destination_start_row - 1,  # 0始まりに変換（移動先の開始行）
-                        'columnIndex': source_start_col - 1  # 0始まりに変換（移動先の開始列）
-                    },
-                    'pasteType': 'PASTE_NORMAL'  # 値と書式（色情報含む）をコピー
+    # 現在のデータを「前回値」シート用に整形（比較用のため、元の構造で保存）
+    # 前回値シートには元の構造（取得日時列 + 空列 + データ）で保存
+    previous_data_for_save = []
+    
+    # ヘッダー行（取得日時列 + 空列 + データ + 変化検出用のハッシュ）
+    # ヘッダーがない場合もハッシュを保存するため、ヘッダー行は必ず書き込む
+    header_row = ['取得日時', ''] + table_data['header'] + [f"{SNAPSHOT_HASH_LABEL}{snapshot_hash}"]
+    previous_data_for_save.append(header_row)
+    
+    # データ行（取得日時 + 空列 + データ）
+    # all_data[0]は取得日時行、all_data[1]は空行（ヘッダーがある場合のみ）なのでスキップ
+    for row in all_data[data_start:]:  # 取得日時行と空行をスキップしてデータ行のみ
+        # 空行はスキップ
+        if row and any(cell for cell in row if cell):  # 空行でない場合のみ
+            row_with_date = [now, ''] + row
+            previous_data_for_save.append(row_with_date)
+    
+    # 履歴の移動・最新データ・区切り線・背景色（前回値シートは最後にまとめて書き換える）
+    requests = _plan_sheet_writes(
+        history_sheet=sh,
+        all_data=all_data,
+        cell_colors=table_data.get('cell_colors') or [],
+        has_history=has_history
+    )
+    
+    # 書き込み後の前回値と履歴のA列（次の取得結果の比較・アーカイブに使う）
+    state['previous_values'] = previous_data_for_save
+    new_head = [[row[0]] if row and row[0] else [] for row in all_data]
+    state['history_head'] = new_head + [['---']] + history_head if has_history else new_head
+    return requests, True
+
+# 履歴ブロックの先頭行（「取得日時: YYYY-MM-DD HH:MM ...」）
+_HISTORY_DATETIME_PATTERN = re.compile(r'取得日時:\s*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2})')
+
+def _history_blocks(column_a):
+    """履歴シートのA列から、取得1回分のブロック [(開始行, 終了行, 取得日時)] を上から順に返す（0始まり・終端を含まない）"""
+    starts = []
+    for row_index, row in enumerate(column_a):
+        match = _HISTORY_DATETIME_PATTERN.match(str(row[0])) if row else None
+        if match:
+            starts.append((row_index, match.group(1)))
+    return [(start, starts[i + 1][0] if i + 1 < len(starts) else len(column_a), fetched_at)
+            for i, (start, fetched_at) in enumerate(starts)]
+
+def _plan_history_archive(service, spreadsheet_id, sheets, history_sheet, column_a):
+    """上限（HISTORY_KEEP_SNAPSHOTS）を超えた古いブロックを月ごとにアーカイブし、履歴シートから削除するリクエストを返す
+    
+    今回の最新データも1ブロックと数える。上限を HISTORY_ARCHIVE_BATCH 回分超えるまでは何もしない。
+    (リクエスト, ファイルに追記する行 {月: [JSON行]}) を返す。ファイルへの追記は、
+    batchUpdate（履歴シートからの削除）が成功した後に _append_history_archive_files で行う。
+    """
+    blocks = _history_blocks(column_a)
+    keep = max(HISTORY_KEEP_SNAPSHOTS - 1, 1)  # 今回追加するブロックの分を除く（最低1ブロックは残す）
+    if len(blocks) + 1 <= HISTORY_KEEP_SNAPSHOTS + HISTORY_ARCHIVE_BATCH or len(blocks) <= keep:
+        return [], {}
+    old_blocks = blocks[keep:]
+    archive_start = old_blocks[0][0]
+    archive_end = len(column_a)
+    # 残すブロックの末尾の区切り線（アーカイブするブロックとの区切り）も一緒に削除する
+    delete_start = archive_start
+    if column_a[archive_start - 1] and str(column_a[archive_start - 1][0]) == '---':
+        delete_start -= 1
+    
+    # 月ごとにまとめる（履歴は新しい順に並んでいるので、同じ月のブロックは連続している）
+    month_groups = []
+    for start, end, fetched_at in old_blocks:
+        month = fetched_at[:7]
+        if month_groups and month_groups[-1][2] == month:
+            month_groups[-1][1] = end
+        else:
+            month_groups.append([start, end, month])
+    
+    requests = []
+    archive_lines = {}
+    if HISTORY_ARCHIVE_MODE == "file":
+        archive_lines = _history_archive_lines(service, spreadsheet_id, history_sheet, archive_start, archive_end, old_blocks)
+    else:
+        num_cols = history_sheet['columnCount']
+        for start, end, month in month_groups:
+            # 次の月との区切り線はコピーしない
+            if column_a[end - 1] and str(column_a[end - 1][0]) == '---':
+                end -= 1
+            title = f"{HISTORY_ARCHIVE_SHEET_PREFIX}{month}"
+            target = sheets.get(title)
+            if target is None:
+                # シートの作成も同じbatchUpdateで行う（失敗したときに空のアーカイブシートが残らないように）
+                target = _new_sheet_request(sheets, title, rows=end - start, cols=num_cols, requests=requests)
+                print(f"アーカイブシート '{title}' を作成します")
+            else:
+                # 履歴シートと同じく新しいものを上にするため、先頭に行を挿入して区切り線を入れる
+                requests.extend(_ensure_grid_requests(target, 0, num_cols))
+                requests.append({
+                    'insertDimension': {
+                        'range': {'sheetId': target['sheetId'], 'dimension': 'ROWS', 'startIndex': 0, 'endIndex': end - start + 1},
+                        'inheritFromBefore': False
+                    }
+                })
+                target['rowCount'] += end - start + 1
+                requests.append(_update_cells_request(target['sheetId'], end - start, [['---']]))
+            # 値と書式（色）をそのままコピー
+            requests.append({
+                'copyPaste': {
+                    'source': _grid_range(history_sheet['sheetId'], start, end, 0, num_cols),
+                    'destination': _grid_range(target['sheetId'], 0, end - start, 0, num_cols),
+                    'pasteType': 'PASTE_NORMAL'
                 }
+            })
+    
+    requests.append({
+        'deleteDimension': {
+            'range': {
+                'sheetId': history_sheet['sheetId'],
+                'dimension': 'ROWS',
+                'startIndex': delete_start,
+                'endIndex': archive_end
             }
+        }
+    })
+    history_sheet['rowCount'] -= archive_end - delete_start
+    # 状態の履歴のA列も削除後の内容にする（同じ状態で続けて書き込むとき、削除済みの行を再びアーカイブしないように）
+    del column_a[delete_start:]
+    destination = HISTORY_ARCHIVE_DIR if HISTORY_ARCHIVE_MODE == "file" else "アーカイブシート"
+    print(f"古い履歴{len(old_blocks)}回分（{archive_end - archive_start}行）を{destination}へ移します")
+    return requests, archive_lines
+
+def _history_archive_lines(service, spreadsheet_id, history_sheet, archive_start, archive_end, old_blocks):
+    """アーカイブするブロックの値を読み込み、月ごとの圧縮ファイルに追記する行 {月: [JSON行]} を返す（色は保存しない）"""
+    values = _execute(service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=_a1_range(history_sheet['title'], f"{archive_start + 1}:{archive_end}")
+    ), "values.get").get('values', [])
+    lines_by_month = {}
+    # ファイルには古い順に追記する
+    for start, end, fetched_at in reversed(old_blocks):
+        rows = [row for row in values[start - archive_start:end - archive_start] if row != ['---']]
+        record = {'fetched_at': fetched_at, 'rows': rows}
+        lines_by_month.setdefault(fetched_at[:7], []).append(json.dumps(record, ensure_ascii=False))
+    return lines_by_month
+
+def _append_history_archive_files(lines_by_month):
+    """月ごとの圧縮ファイル（JSON Lines + gzip）に追記する"""
+    if not lines_by_month:
+        return
+    os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+    for month, lines in lines_by_month.items():
+        # gzipは追記（複数メンバーの連結）してもそのまま展開できる
+        path = os.path.join(HISTORY_ARCHIVE_DIR, f"history_{month}.jsonl.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+# --- 前回値との比較（会合日・金利レンジごとに差分を計算） ---
+
+_NUMBER_PATTERN = re.compile(r'\d+\.?\d*')
+
+def _extract_number(value):
+    """セルから数値を抽出（例: '88.4% ↑ +1.2%' → 88.4）"""
+    if not value or not isinstance(value, str):
+        return None
+    match = _NUMBER_PATTERN.search(value)
+    return float(match.group(0)) if match else None
+
+def _bucket_row(rows):
+    """'%' を含まず2列以上が埋まっている最初の行（金利レンジの見出し行）を返す（なければNone）"""
+    return next((row for row in rows
+                 if sum(1 for cell in row[1:] if str(cell).strip()) >= 2
+                 and not any('%' in str(cell) for cell in row)), None)
+
+def _probability_cells(rows):
+    """確率のセルを {(行, 列): (比較キー, 数値)} にまとめる
+    
+    比較キーは (会合日, 金利レンジ)。見出し行が見つからない表では (行, 列) の位置で比較する。
+    """
+    bucket_row = _bucket_row(rows)
+    cells = {}
+    for row_index, row in enumerate(rows):
+        for col_index, value in enumerate(row):
+            if not value or '%' not in str(value):
+                continue
+            bucket = str(bucket_row[col_index]).strip() if bucket_row is not None and 0 < col_index < len(bucket_row) else ''
+            if bucket:
+                key = (_normalize_meeting_date(row[0]), bucket)
+            else:
+                key = (row_index, col_index)
+            cells[(row_index, col_index)] = (key, _extract_number(str(value)))
+    return cells
+
+def _compare_tables(current_rows, previous_rows, threshold=MIN_CHANGE_THRESHOLD):
+    """現在の表を前回の表と比較し、確率のセルに矢印と増減を付けた表示用の行を返す
+    
+    先に全セルの差分をまとめて計算し、文字列は最後に組み立てる。
+    会合日の行が増減・移動しても、同じ会合日・金利レンジどうしを比較する。
+    """
+    current = _probability_cells(current_rows)
+    previous = {key: number for key, number in _probability_cells(previous_rows).values() if number is not None}
+    diffs = {
+        position: number - previous[key]
+        for position, (key, number) in current.items()
+        if number is not None and key in previous
+    }
+    
+    rendered = []
+    for row_index, row in enumerate(current_rows):
+        row_data = []
+        for col_index, value in enumerate(row):
+            diff = diffs.get((row_index, col_index))
+            if not value:
+                row_data.append("")
+            elif diff is None:
+                # 確率以外のセル、または前回値がない場合（初回実行など）は矢印・増減率なし
+                row_data.append(value)
+            elif abs(diff) > threshold:
+                row_data.append(f"{value} ↑ +{diff:.1f}%" if diff > 0 else f"{value} ↓ {diff:.1f}%")
+            else:
+                row_data.append(f"{value} → ±0.0%")
+        rendered.append(row_data)
+    return rendered
+
+def _snapshot_hash(table_data):
+    """値（前後の空白を除く）と色（小数第3位で丸め）から、スナップショットのハッシュを計算"""
+    normalized = {
+        'rows': [[str(cell).strip() for cell in row] for row in table_data.get('rows') or []],
+        'cell_colors': [
+            [{k: round(v, 3) for k, v in sorted(color.items())} if color else None for color in row]
+            for row in table_data.get('cell_colors') or []
+        ]
+    }
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def _stored_snapshot_hash(previous_values):
+    """前回値シートのヘッダー行に保存したハッシュを取り出す（なければNone）"""
+    if not previous_values:
+        return None
+    for cell in previous_values[0]:
+        if str(cell).startswith(SNAPSHOT_HASH_LABEL):
+            return str(cell)[len(SNAPSHOT_HASH_LABEL):]
+    return None
+
+# --- 4. 書き込み計画（batchUpdate用のリクエストを組み立てる） ---
+
+def _a1_range(sheet_title, cell_range=None):
+    """シート名（必要ならクォート）とセル範囲からA1表記を作成"""
+    quoted = "'" + sheet_title.replace("'", "''") + "'"
+    return f"{quoted}!{cell_range}" if cell_range else quoted
+
+# 最新データ部分の背景色（白色）
+WHITE = {"red": 1.0, "green": 1.0, "blue": 1.0}
+
+def _grid_range(sheet_id, start_row, end_row, start_col, end_col):
+    """0始まり・終端を含まない GridRange を作成"""
+    return {
+        'sheetId': sheet_id,
+        'startRowIndex': start_row,
+        'endRowIndex': end_row,
+        'startColumnIndex': start_col,
+        'endColumnIndex': end_col
+    }
+
+def _update_cells_request(sheet_id, row_index, values):
+    """値を文字列のまま書き込む updateCells リクエスト（空文字のセルはクリア）"""
+    return {
+        'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': row_index, 'columnIndex': 0},
+            'rows': [
+                {'values': [{'userEnteredValue': {'stringValue': str(value)}} if value != '' else {} for value in row]}
+                for row in values
+            ],
+            'fields': 'userEnteredValue'
+        }
+    }
+
+def _background_request(grid_range, color):
+    """範囲の背景色を設定する repeatCell リクエスト"""
+    return {
+        'repeatCell': {
+            'range': grid_range,
+            'cell': {'userEnteredFormat': {'backgroundColor': color}},
+            'fields': 'userEnteredFormat.backgroundColor'
+        }
+    }
+
+def _ensure_grid_requests(sheet, rows_needed, cols_needed):
+    """シートの行数・列数が足りない場合に拡張する appendDimension リクエスト（シート情報の行数・列数も更新）"""
+    requests = []
+    if rows_needed > sheet['rowCount']:
+        requests.append({'appendDimension': {'sheetId': sheet['sheetId'], 'dimension': 'ROWS', 'length': rows_needed - sheet['rowCount']}})
+        sheet['rowCount'] = rows_needed
+    if cols_needed > sheet['columnCount']:
+        requests.append({'appendDimension': {'sheetId': sheet['sheetId'], 'dimension': 'COLUMNS', 'length': cols_needed - sheet['columnCount']}})
+        sheet['columnCount'] = cols_needed
+    return requests
+
+def _coalesce_color_ranges(cell_colors, start_row_index):
+    """同じ色の隣接セルを1つの範囲にまとめる（行内で連結したあと、同じ列範囲の連続行を連結）
+    
+    cell_colors の各行は [取得日時列用None, 空列用None, 列Aの色, 列Bの色, ...] の形式。
+    戻り値は [(開始行, 終了行, 開始列, 終了列, 色)]（0始まり・終端を含まない）。
+    """
+    ranges = []
+    open_ranges = {}  # (開始列, 終了列, 色) → 直前の行まで伸ばした範囲
+    for row_offset, row_colors in enumerate(cell_colors):
+        row_index = start_row_index + row_offset
+        colors = row_colors[2:]  # 取得日時列と空列はスプレッドシートにないのでスキップ
+        col = 0
+        while col < len(colors):
+            color = colors[col]
+            if color is None:
+                col += 1
+                continue
+            end = col + 1
+            while end < len(colors) and colors[end] == color:
+                end += 1
             
-            # バッチリクエストで実行
-            batch_request = {
-                'requests': [cut_paste_request]
+            key = (col, end, tuple(sorted(color.items())))
+            previous = open_ranges.get(key)
+            if previous is not None and previous[1] == row_index:
+                previous[1] = row_index + 1
+            else:
+                previous = [row_index, row_index + 1, col, end, color]
+                open_ranges[key] = previous
+                ranges.append(previous)
+            col = end
+    return [tuple(r) for r in ranges]
+
+def _plan_sheet_writes(history_sheet, all_data, cell_colors, has_history):
+    """1回分の取得結果について、履歴シートへのリクエストを順番に組み立てる
+    
+    1. 先頭に行を挿入して既存データ（履歴）を色込みで下にずらす
+    2. 最新データ範囲の背景色を白にクリア
+    3. 最新データと区切り線を書き込み
+    4. CMEサイトの色を同色範囲ごとにまとめて適用
+    """
+    requests = []
+    history_id = history_sheet['sheetId']
+    new_data_rows = len(all_data)
+    num_cols = max(len(row) for row in all_data) if all_data else 0
+    
+    # 1. 先頭に「最新データ + 区切り線」分の行を挿入して、既存データを色込みで下にずらす
+    # （範囲を指定しないので、既存データの大きさを読み込む必要がない）
+    if has_history and new_data_rows > 0:
+        requests.extend(_ensure_grid_requests(history_sheet, 0, num_cols))
+        requests.append({
+            'insertDimension': {
+                'range': {
+                    'sheetId': history_id,
+                    'dimension': 'ROWS',
+                    'startIndex': 0,
+                    'endIndex': new_data_rows + 1
+                },
+                'inheritFromBefore': False
             }
-            
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id,
-                body=batch_request
-            ).execute()
-            
-            print(f"既存データを色込みで下に移動しました（{source_end_row - source_start_row + 1}行）")
-        except Exception as e:
-            print(f"既存データの移動でエラー（続行します）: {e}")
+        })
+        history_sheet['rowCount'] += new_data_rows + 1
+    else:
+        requests.extend(_ensure_grid_requests(history_sheet, new_data_rows, num_cols))
     
-    # 最新データを上に書き込み
-    if len(all_data) > 0:
-        # 最新データ部分の背景色をクリア（白色に設定）
-        new_data_rows = len(all_data)
-        num_cols = max(len(row) for row in all_data) if all_data else 0
+    if new_data_rows > 0 and num_cols > 0:
+        # 2. 最新データ部分のみ背景色を白色にクリア
+        requests.append(_background_request(_grid_range(history_id, 0, new_data_rows, 0, num_cols), WHITE))
         
-        if num_cols > 0 and new_data_rows > 0:
-            # 最新データ部分のみ背景色を白色にクリア
-            clear_range = f"A1:{col_num_to_letter(num_cols)}{new_data_rows}"
+        # 3. 最新データと区切り線を書き込み
+        requests.append(_update_cells_request(history_id, 0, all_data))
+        if has_history:
+            separator_row = ['---'] + [''] * (num_cols - 1)
+            requests.append(_update_cells_request(history_id, new_data_rows, [separator_row]))
+    
+    # 4. CMEサイトから取得した色情報を適用（1行目: 取得日時、2行目: 空行、3行目からデータ行）
+    color_ranges = _coalesce_color_ranges(cell_colors, start_row_index=2)
+    for start_row, end_row, start_col, end_col, color in color_ranges:
+        requests.append(_background_request(_grid_range(history_id, start_row, end_row, start_col, end_col), color))
+    colored_cells = sum((r[1] - r[0]) * (r[3] - r[2]) for r in color_ranges)
+    if colored_cells > 0:
+        print(f"CMEサイトの色情報を{colored_cells}個のセルに適用します（{len(color_ranges)}範囲にまとめました）")
+    
+    return requests
+
+def _previous_sheet_requests(previous_sheet, previous_rows):
+    """「前回値」シートをクリアしてから現在のデータを保存するリクエスト"""
+    requests = []
+    if previous_rows:
+        previous_cols = max(len(row) for row in previous_rows)
+        requests.extend(_ensure_grid_requests(previous_sheet, len(previous_rows), previous_cols))
+        requests.append({'updateCells': {'range': {'sheetId': previous_sheet['sheetId']}, 'fields': 'userEnteredValue'}})
+        requests.append(_update_cells_request(previous_sheet['sheetId'], 0, previous_rows))
+    return requests
+
+
+# --- ローカル時系列ストア（SQLite） ---
+# 1回の取得を (取得日時, 会合日, 金利レンジ, 確率) の行に分解して保存する
+# 分析ではスプレッドシートを読み直さずに、会合日ごとの確率の推移をここから取り出す
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probabilities (
+    fetched_at   TEXT NOT NULL,  -- 取得日時（UTC, ISO 8601）
+    meeting_date TEXT NOT NULL,  -- 会合日（YYYY-MM-DD に揃える。解釈できなければ取得したままの文字列）
+    rate_bucket  TEXT NOT NULL,  -- 金利レンジ（例: 350-375）
+    probability  REAL NOT NULL,  -- 確率（%）
+    PRIMARY KEY (fetched_at, meeting_date, rate_bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_probabilities_meeting ON probabilities (meeting_date, fetched_at);
+"""
+
+_MEETING_DATE_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d %b %Y", "%d%b%Y", "%d %b %y", "%b %d %Y", "%b %d, %Y")
+
+_history_db = None
+
+def _get_history_db():
+    """時系列データベースに接続（2回目以降は接続済みのものを返す）"""
+    global _history_db
+    if _history_db is None:
+        folder = os.path.dirname(HISTORY_DB_FILE)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        _history_db = sqlite3.connect(HISTORY_DB_FILE)
+        # 分析側が読んでいる間も書き込めるようにする
+        _history_db.execute("PRAGMA journal_mode=WAL")
+        _history_db.executescript(_HISTORY_SCHEMA)
+    return _history_db
+
+def _normalize_meeting_date(text):
+    """会合日の表記を YYYY-MM-DD に揃える（解釈できなければ前後の空白を除いた文字列）"""
+    text = str(text).strip()
+    match = _DATE_PATTERN.search(text)
+    candidate = match.group(0) if match else text
+    for date_format in _MEETING_DATE_FORMATS:
+        try:
+            return datetime.strptime(candidate, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return text
+
+def _probability_records(table_data):
+    """テーブルを (会合日, 金利レンジ, 確率) の組に分解する
+    
+    '%' を含まず2列以上が埋まっている最初の行を金利レンジの見出し行、
+    '%' を含む行を会合日ごとの確率の行とみなす。見出し行が行の中にない表では、ヘッダー行を使う。
+    """
+    rows = table_data.get('rows') or []
+    bucket_row = _bucket_row(rows) or _bucket_row([table_data.get('header') or []])
+    if bucket_row is None:
+        return []
+    records = []
+    for row in rows:
+        if not row or not any('%' in str(cell) for cell in row):
+            continue
+        meeting_date = _normalize_meeting_date(row[0])
+        for bucket, cell in zip(bucket_row[1:], row[1:]):
+            probability = _to_float(str(cell).split()[0]) if str(cell).strip() else None
+            if probability is not None and str(bucket).strip():
+                records.append((meeting_date, str(bucket).strip(), probability))
+    return records
+
+def store_snapshot(table_data, fetched_at=None):
+    """取得したテーブルを時系列データベースに保存し、保存した件数を返す"""
+    if not HISTORY_DB_FILE:
+        return 0
+    fetched_at = (fetched_at or datetime.now(timezone.utc)).astimezone(timezone.utc).isoformat(timespec="seconds")
+    records = _probability_records(table_data)
+    db = _get_history_db()
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO probabilities (fetched_at, meeting_date, rate_bucket, probability) VALUES (?, ?, ?, ?)",
+            [(fetched_at,) + record for record in records]
+        )
+    return len(records)
+
+def query_probability_path(meeting_date, days=30, rate_bucket=None):
+    """指定した会合日の確率の推移（直近 days 日分）を取得日時の順に返す
+    
+    戻り値: [{'fetched_at': ..., 'rate_bucket': ..., 'probability': ...}, ...]
+    """
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat(timespec="seconds")
+    sql = ("SELECT fetched_at, rate_bucket, probability FROM probabilities"
+           " WHERE meeting_date = ? AND fetched_at >= ?")
+    params = [_normalize_meeting_date(meeting_date), since]
+    if rate_bucket is not None:
+        sql += " AND rate_bucket = ?"
+        params.append(str(rate_bucket).strip())
+    sql += " ORDER BY fetched_at, rate_bucket"
+    return [{'fetched_at': fetched_at, 'rate_bucket': bucket, 'probability': probability}
+            for fetched_at, bucket, probability in _get_history_db().execute(sql, params)]
+
+# --- 書き込み待ちの取得結果（スプール） ---
+# 取得に成功したら、スプレッドシートに書き込む前にファイルへ追記する
+# 書き込めた分だけファイルから取り除くので、Googleに接続できない間の取得結果も失われない
+
+def _spool_file(spreadsheet_name=SPREADSHEET_NAME):
+    """書き込み先ごとのスプールファイル（既定のスプレッドシートは SPOOL_FILE そのもの）
+    
+    ほかの書き込み先は、名前のハッシュを付けたファイルにする（名前に使えない文字が含まれていてもよいように）。
+    """
+    if not SPOOL_FILE or spreadsheet_name == SPREADSHEET_NAME:
+        return SPOOL_FILE
+    root, ext = os.path.splitext(SPOOL_FILE)
+    return f"{root}.{hashlib.sha1(spreadsheet_name.encode('utf-8')).hexdigest()[:10]}{ext}"
+
+def _dead_letter_file(spreadsheet_name=SPREADSHEET_NAME):
+    """書き込めない取得結果を移すファイル（スプールファイルの拡張子の前に .dead を付ける）"""
+    root, ext = os.path.splitext(_spool_file(spreadsheet_name))
+    return f"{root}.dead{ext}"
+
+def _append_line_durably(path, line):
+    """1行を追記し、ディスクに書き込まれるまで待つ"""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+def spool_snapshot(table_data, fetched_at):
+    """取得結果を書き込み先ごとのスプールに追記する（ディスクに書き込まれるまで待つ）"""
+    if not SPOOL_FILE:
+        return
+    folder = os.path.dirname(SPOOL_FILE)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    entry = {'fetched_at': fetched_at.isoformat(timespec="seconds"), 'table': table_data}
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    for spreadsheet_name in SPREADSHEET_TARGETS:
+        _append_line_durably(_spool_file(spreadsheet_name), line)
+
+def _pending_snapshots(spreadsheet_name=SPREADSHEET_NAME):
+    """スプールにある書き込み待ちの取得結果を古い順に返す（書きかけの行は読み飛ばす）"""
+    spool_file = _spool_file(spreadsheet_name)
+    if not spool_file or not os.path.exists(spool_file):
+        return []
+    entries = []
+    with open(spool_file, encoding="utf-8") as f:
+        for line in f:
             try:
-                sh.format(clear_range, {
-                    "backgroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0}  # 白色
-                })
-                print(f"最新データ範囲 {clear_range} の背景色をクリアしました")
-            except Exception as e:
-                print(f"背景色のクリアでエラー（続行します）: {e}")
-        
-        # 最新データを書き込み
-        sh.update(values=all_data, range_name='A1')
-        print(f"最新データ{len(all_data)}行を書き込みました")
-        
-        # 既存データがある場合、区切り線を追加
-        if existing_data and len(existing_data) > 0:
-            separator_row = ['---'] + [''] * (num_cols - 1) if num_cols > 0 else ['---']
-            separator_row_num = len(all_data) + 1
-            sh.update(values=[separator_row], range_name=f'A{separator_row_num}')
-            print(f"区切り線を{separator_row_num}行目に追加しました")
-    
-    # 背景色の自動設定は無効化（矢印のみ表示）
-    # 変化に応じた色情報の適用は行わない
-    # ただし、CMEサイトから取得した色情報は適用する
-    
-    # CMEサイトから取得した色情報を適用（最新データのみ）
-    if 'cell_colors' in table_data and table_data['cell_colors']:
-        print("CMEサイトから取得した色情報を適用中（最新データのみ）...")
-        cell_colors = table_data['cell_colors']
-        
-        # 取得日時行と空行を考慮して、データ行の開始行番号を計算（3行目から）
-        # 1行目: 取得日時、2行目: 空行、3行目: データ行1（MEETING DATE行）
-        start_row = 3
-        
-        colored_cell_count = 0
-        error_count = 0
-        
-        for row_idx, row_colors in enumerate(cell_colors):
-            sheet_row = start_row + row_idx
-            
-            for col_idx, color_info in enumerate(row_colors):
-                # row_colors[0] = None（取得日時列用、スキップ）
-                # row_colors[1] = None（空列用、スキップ）
-                # row_colors[2]以降 = テーブルのデータ列の色
-                # スプレッドシートでは取得日時列と空列が削除されているので、
-                # row_colors[2]は列A、row_colors[3]は列Bになる
-                if col_idx >= 2 and color_info is not None:  # 取得日時列と空列をスキップ
-                    try:
-                        # スプレッドシートの列は取得日時列と空列がないので、col_idx - 2
-                        sheet_col_idx = col_idx - 2
-                        col_letter = col_num_to_letter(sheet_col_idx + 1)
-                        cell_range = f"{col_letter}{sheet_row}"
-                        
-                        # gspreadのformatメソッドで背景色を設定
-                        sh.format(cell_range, {
-                            "backgroundColor": color_info
-                        })
-                        colored_cell_count += 1
-                    except Exception as e:
-                        error_count += 1
-                        if error_count <= 5:  # 最初の5つのエラーのみ表示
-                            print(f"  セル {col_letter}{sheet_row} の色設定でエラー: {e}")
-                        continue
-        
-        if colored_cell_count > 0:
-            print(f"CMEサイトの色情報を{colored_cell_count}個のセルに適用しました（最新データのみ）")
-        if error_count > 0:
-            print(f"警告: {error_count}個のセルで色設定に失敗しました")
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"スプールの壊れた行を読み飛ばします: {line[:80]!r}")
+    return entries
+
+def flush_spool(prefetched=None, spreadsheet_name=SPREADSHEET_NAME):
+    """スプールの取得結果を古い順に、SPOOL_FLUSH_BATCH 件ずつ1回のbatchUpdateで書き込む
     
-    # 現在のデータを「前回値」シートに保存（比較用のため、元の構造で保存）
+    書き込めた分はスプールから取り除く。書き込んだ（前回から変化があった）件数を返す。
+    SPOOL_DEAD_LETTER_STATUSES のエラーになったら1件ずつ書き込み直し、それでも書き込めない取得結果は
+    書き込めない分のファイルへ移して、後ろの取得結果の書き込みを続ける。
+    """
+    pending = _pending_snapshots(spreadsheet_name)
+    if not pending:
+        return 0
+    if len(pending) > 1:
+        print(f"'{spreadsheet_name}' への書き込み待ちの取得結果が{len(pending)}件あります（古い順に書き込みます）")
+    state = prefetched if prefetched is not None else {}  # 最初のバッチで読み込み、以降のバッチで使い回す
+    written = 0
+    remaining = pending
+    batch_size = SPOOL_FLUSH_BATCH
+    while remaining:
+        batch = remaining[:batch_size]
+        snapshots = [(entry['table'], datetime.fromisoformat(entry['fetched_at']).strftime("%Y-%m-%d %H:%M"))
+                     for entry in batch]
+        try:
+            written += write_snapshots(snapshots, state, spreadsheet_name)
+        except Exception as e:
+            status = _http_status(e)
+            if status not in SPOOL_DEAD_LETTER_STATUSES:
+                raise
+            if len(batch) > 1:
+                # どの取得結果が原因か分からないので、ここから先は1件ずつ書き込む
+                print(f"Google APIが {status} を返しました（'{spreadsheet_name}'、1件ずつ書き込み直します）")
+                batch_size = 1
+                continue
+            dead_letter = dict(batch[0], status=status, error=str(e)[:500])
+            _append_line_durably(_dead_letter_file(spreadsheet_name), json.dumps(dead_letter, ensure_ascii=False) + "\n")
+            _trace.count("spool_dead_lettered")
+            print(f"{batch[0]['fetched_at']} の取得結果は書き込めません（{status}）。"
+                  f"{_dead_letter_file(spreadsheet_name)} へ移し、後ろの取得結果の書き込みを続けます: {e}")
+        # 書き込めた（または移した）分を取り除く（途中で失敗しても、書き込んだ分を二重に書かない）
+        remaining = remaining[len(batch):]
+        _write_file_atomically(_spool_file(spreadsheet_name), "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in remaining))
+    _trace.count("spool_flushed", len(pending))
+    return written
+
+# --- 5. 実行（1回だけ実行 / 常駐モード） ---
+
+def run_once(session=None):
+    """スクレイピングしてスプレッドシートに書き込む（1回分）。計測結果は RUN_REPORT_FILE に書き出す"""
+    global _trace
+    _trace = _RunTrace()
+    memory = _MemorySampler()
     try:
-        previous_sheet.clear()
-        # 前回値シートには元の構造（取得日時列 + 空列 + データ）で保存
-        previous_data_for_save = []
-        
-        # ヘッダー行（取得日時列 + 空列 + データ）
-        if table_data['header']:
-            header_row = ['取得日時', ''] + table_data['header']
-            previous_data_for_save.append(header_row)
-        
-        # データ行（取得日時 + 空列 + データ）
-        # all_data[0]は取得日時行、all_data[1]は空行なのでスキップ
-        # all_data[2]以降がデータ行
-        for row in all_data[2:]:  # 取得日時行と空行をスキップしてデータ行のみ
-            # 空行はスキップ
-            if row and any(cell for cell in row if cell):  # 空行でない場合のみ
-                row_with_date = [now, ''] + row
-                previous_data_for_save.append(row_with_date)
-        
-        if len(previous_data_for_save) > 0:
-            previous_sheet.update(values=previous_data_for_save, range_name='A1')
-            print(f"現在のデータを「前回値」シートに保存しました（{len(previous_data_for_save)}行）")
+        with memory:
+            _run_once_traced(session)
+    except BaseException as e:
+        _finish_run(memory, "error", e)
+        raise
+    _finish_run(memory, "ok")
+
+def _finish_run(memory, status, error=None):
+    """APIの使用量とメモリのピークを表示し、計測結果を書き出す"""
+    _print_quota_use()
+    _trace.memory = memory.peaks()
+    _print_memory_use(_trace.memory)
+    _trace.write(status, error)
+
+def _print_quota_use():
+    """今回の実行で使ったSheets APIの割り当て（読み取り・書き込みの回数）を表示"""
+    quota = _trace.counters.get("google_api_quota", {})
+    retries = sum(_trace.counters.get("google_api_retries", {}).values())
+    throttled = _trace.stages.get("google_api_throttle", {}).get('seconds', 0.0)
+    print(f"Sheets APIの使用量: 読み取り{quota.get('read', 0)}回 / 書き込み{quota.get('write', 0)}回"
+          f"（再試行{retries}回、間隔調整の待機{throttled:.1f}秒）")
+
+def _run_once_traced(session):
+    targets = SPREADSHEET_TARGETS
+    pool = _target_pool()
+    # スプレッドシートの読み込みを、ブラウザでの取得と並行して進める（書き込み先ごと）
+    prefetches = {name: pool.submit(prefetch_sheet_state, name) for name in targets}
+    try:
+        with _trace.stage("scrape"):
+            table_data = scrape_fed_data(session)
+    except BaseException:
+        for future in prefetches.values():
+            future.cancel()
+        raise
+    _save_snapshot_locally(table_data)
+    # 取得は1回だけ。書き込みは書き込み先ごとに並行して行う（全体の時間は一番遅い書き込み先の分）
+    with _trace.stage("sheets_targets"):
+        results, errors = _for_each_target(
+            pool, lambda name: _write_target(table_data, name, prefetches[name]), targets)
+    for name in targets:
+        if name not in results:
+            continue
+        label = f"'{name}'" if len(targets) > 1 else "スプレッドシート"
+        if results[name]:
+            _trace.count("snapshots_written", results[name])
+            print(f"成功: テーブル全体（{len(table_data['rows'])}行）を{label}に書き込みました")
+        else:
+            _trace.count("snapshots_unchanged")
+            print(f"成功: 前回から変化がないため、{label}の履歴は追加しませんでした")
+    _raise_target_errors(errors, targets)
+
+_target_executor = None
+_target_executor_lock = threading.Lock()
+
+def _target_pool():
+    """書き込み先ごとの処理を並行して行うスレッドプール（同時に SHEETS_TARGET_CONCURRENCY 個まで）
+    
+    プロセスの間は同じプールを使い回す（常駐モード・ライブモードでも、スレッドごとの Sheets API のサービスを作り直さない）。
+    """
+    global _target_executor
+    with _target_executor_lock:
+        if _target_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _target_executor = ThreadPoolExecutor(
+                max_workers=max(1, min(len(SPREADSHEET_TARGETS), SHEETS_TARGET_CONCURRENCY)),
+                thread_name_prefix="sheets")
+        return _target_executor
+
+def _for_each_target(pool, fn, targets):
+    """fn(スプレッドシート名) を書き込み先ごとに pool で実行し、({名前: 結果}, {名前: 例外}) を返す
+    
+    1つの書き込み先で失敗しても、ほかの書き込み先はそのまま続ける。
+    """
+    futures = {name: pool.submit(fn, name) for name in targets}
+    results = {}
+    errors = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors[name] = e
+            _trace.count("target_errors", kind=name)
+            print(f"'{name}' への書き込みでエラー: {e}")
+    return results, errors
+
+def _raise_target_errors(errors, targets):
+    """書き込めなかった書き込み先があれば、まとめて例外にする（書き込めた分はそのまま）"""
+    if not errors:
+        return
+    if len(targets) == 1:
+        raise next(iter(errors.values()))
+    names = ", ".join(f"'{name}'" for name in errors)
+    raise Exception(f"{len(targets)}件中{len(errors)}件のスプレッドシートに書き込めませんでした: {names}")
+
+def _write_target(table_data, spreadsheet_name, prefetch):
+    """1つの書き込み先に書き込む（prefetch は事前読み込みの Future）"""
+    try:
+        prefetched = prefetch.result()
     except Exception as e:
-        print(f"前回値シートへの保存でエラー: {e}")
+        # 書き込みの中で読み込みからやり直す
+        print(f"'{spreadsheet_name}' の事前読み込みでエラー（書き込み時に読み込み直します）: {e}")
+        prefetched = None
+    return _write_snapshot(table_data, prefetched, spreadsheet_name)
+
+def _save_snapshot_locally(table_data):
+    """取得結果をスプールと時系列データベースに保存する（スプレッドシートへの書き込みより先に行う）"""
+    fetched_at = datetime.now().astimezone()
+    # 書き込みに失敗しても取得結果が残るように、先にスプールへ保存する
+    spool_snapshot(table_data, fetched_at)
+    try:
+        with _trace.stage("local_store"):
+            stored = store_snapshot(table_data, fetched_at)
+        if stored:
+            print(f"時系列データベースに{stored}件保存しました: {HISTORY_DB_FILE}")
+    except sqlite3.Error as e:
+        # ローカル保存の失敗でスプレッドシートへの書き込みを止めない
+        print(f"時系列データベースへの保存でエラー（スプレッドシートへの書き込みは続行）: {e}")
+
+def _write_snapshot(table_data, prefetched=None, spreadsheet_name=SPREADSHEET_NAME):
+    """スプールの取得結果（スプールを使わない場合は table_data）をスプレッドシートに書き込み、書き込んだ件数を返す"""
+    try:
+        if SPOOL_FILE:
+            return flush_spool(prefetched, spreadsheet_name)
+        return int(update_sheet(table_data, prefetched, spreadsheet_name))
+    except Exception:
+        if SPOOL_FILE:
+            print(f"'{spreadsheet_name}' に書き込めませんでした"
+                  f"（取得結果は {_spool_file(spreadsheet_name)} に保存済みで、次回の実行時に書き込みます）")
+        raise
+
+def _next_scheduled_time(now):
+    """次の実行時刻（日本時間の SCHEDULE_HOURS_JST のいずれか）を返す"""
+    now_jst = now.astimezone(JST)
+    for day_offset in (0, 1):
+        day = (now_jst + timedelta(days=day_offset)).date()
+        for hour in SCHEDULE_HOURS_JST:
+            candidate = datetime(day.year, day.month, day.day, hour, tzinfo=JST)
+            if candidate > now_jst:
+                return candidate
+    raise ValueError(f"実行時刻の設定が正しくありません: {SCHEDULE_HOURS_JST}")
+
+def _sleep_until(target):
+    """指定時刻まで待機（PCのスリープや時刻補正に備えて、1分ごとに現在時刻を確認）"""
+    while True:
+        remaining = (target - datetime.now(JST)).total_seconds()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 60))
+
+def _retry_spool_until(target):
+    """次の実行時刻まで、書き込み待ちの取得結果があれば SPOOL_RETRY_INTERVAL 秒ごとに書き込みを再試行"""
+    while True:
+        pending = [name for name in SPREADSHEET_TARGETS if _pending_snapshots(name)]
+        if not pending:
+            return
+        retry_at = datetime.now(JST) + timedelta(seconds=SPOOL_RETRY_INTERVAL)
+        if retry_at >= target:
+            return
+        _sleep_until(retry_at)
+        _, errors = _for_each_target(_target_pool(), lambda name: flush_spool(spreadsheet_name=name), pending)
+        if errors:
+            print(f"書き込み待ちの取得結果を書き込めなかったスプレッドシートがあります（{SPOOL_RETRY_INTERVAL}秒後に再試行）")
+        else:
+            print("書き込み待ちだった取得結果をスプレッドシートに書き込みました")
+
+def run_daemon():
+    """常駐モード: ブラウザとスプレッドシートの接続を保ったまま、指定時刻ごとに実行"""
+    # ログファイルへ即座に出力されるように行単位でフラッシュ
+    sys.stdout.reconfigure(line_buffering=True)
+    print(f"常駐モードで起動しました（実行時刻: {', '.join(f'{h}:00' for h in SCHEDULE_HOURS_JST)} 日本時間）")
     
-    print("スプレッドシートへの書き込み完了")
+    session = _BrowserSession()
+    try:
+        while True:
+            next_run = _next_scheduled_time(datetime.now(JST))
+            print(f"次回の実行: {next_run.strftime('%Y-%m-%d %H:%M')}（日本時間）")
+            _retry_spool_until(next_run)
+            _sleep_until(next_run)
+            try:
+                run_once(session)
+            except Exception as e:
+                print(f"エラー: {e}")
+                # 次回はブラウザを起動し直してから実行する
+                session.close_browser()
+    except KeyboardInterrupt:
+        print("常駐モードを終了します")
+    finally:
+        session.close()
 
-if __name__ == "__main__":
+def run_live(flush_seconds=None):
+    """ライブモード: 表を開いたまま変化を受け取り、flush_seconds 秒以上の間隔で書き込む"""
+    flush_seconds = LIVE_FLUSH_SECONDS if flush_seconds is None else flush_seconds
+    sys.stdout.reconfigure(line_buffering=True)
+    print(f"ライブモードで起動しました（変化があれば最短{flush_seconds:.0f}秒ごとに書き込みます）")
+    
+    global _trace
+    session = _BrowserSession()
+    pool = _target_pool()
+    live = None
+    states = {}  # 書き込み先ごとの、書き込みのたびに更新されるスプレッドシートの状態（読み込みを省く）
+    last_flush = 0.0
     try:
+        with _MemorySampler() as memory:  # ピークはライブモードを開始してからの値
+            while True:
+                try:
+                    if live is None:
+                        # 最初の取得（ページを開いてProbabilitiesを表示する）と監視の設置
+                        _trace = _RunTrace()
+                        table_data = scrape_fed_data(session)
+                        live = _start_live_table(session.page)
+                        print(f"表の監視を開始しました（{len(table_data['rows'])}行）")
+                        live.dirty = True
+                    
+                    session.page.wait_for_timeout(LIVE_POLL_INTERVAL)  # この間にブラウザからの通知を受け取る
+                    if live.frame_detached():
+                        raise Exception("quikstrikeのiframeが読み込み直されたため、監視を設置し直します")
+                    if live.dirty and time.monotonic() - last_flush >= flush_seconds:
+                        live.dirty = False
+                        last_flush = time.monotonic()
+                        table_data = live.table()
+                        _save_snapshot_locally(table_data)
+                        
+                        def write_target(name, table_data=table_data):
+                            # 最初の書き込みで読み込み、以降は書き込み後の状態（アーカイブで削除した行も反映済み）を使い回す
+                            return _write_snapshot(table_data, states.setdefault(name, {}), name)
+                        
+                        results, errors = _for_each_target(pool, write_target, SPREADSHEET_TARGETS)
+                        for name in errors:
+                            states.pop(name, None)  # 失敗した書き込み先だけ、次の書き込みで読み直す
+                        _raise_target_errors(errors, SPREADSHEET_TARGETS)
+                        _trace.count("live_flushes")
+                        _trace.memory = memory.peaks()
+                        _trace.write("ok")
+                        _trace = _RunTrace()
+                        if any(results.values()):
+                            print(f"変化を書き込みました（{datetime.now().strftime('%H:%M:%S')}）")
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    print(f"エラー: {e}")
+                    _trace.memory = memory.peaks()
+                    _trace.write("error", e)
+                    _trace = _RunTrace()
+                    page_alive = session.page is not None and not session.page.is_closed()
+                    if live is None or not page_alive or live.frame_detached():
+                        # ブラウザを起動し直して、監視を設置し直す
+                        live = None
+                        session.close_browser()
+                        time.sleep(RETRY_DELAY)
+                    else:
+                        # 書き込みに失敗しただけなら、次の間隔で書き込み直す（取得結果はスプールに残っている）
+                        live.dirty = True
+    except KeyboardInterrupt:
+        print("ライブモードを終了します")
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CME FedWatch のデータを取得して Google スプレッドシートに書き込みます")
+    parser.add_argument("--daemon", action="store_true", help="常駐して指定時刻（日本時間）ごとに実行する")
+    parser.add_argument("--live", action="store_true", help="表を開いたまま変化を受け取り、変化があれば書き込む（FOMCなどの前後向け）")
+    parser.add_argument("--live-interval", type=float, metavar="SECONDS",
+                        help="--live で書き込む最短の間隔（秒、省略時は CME_LIVE_FLUSH_SECONDS）")
+    parser.add_argument("--views", nargs="?", const="", metavar="VIEW,...",
+                        help="複数のビュー（タブ名、カンマ区切り）を同時に取得してJSONで出力する（スプレッドシートには書き込まない）")
+    parser.add_argument("--output", metavar="FILE", help="--views / --history の結果を書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--history", metavar="MEETING_DATE",
+                        help="時系列データベースから、指定した会合日の確率の推移をJSONで出力する（例: 2026-12-09）")
+    parser.add_argument("--days", type=int, default=30, help="--history で出力する期間（直近の日数、既定: 30）")
+    parser.add_argument("--dry-run", action="store_true", help="取得だけ行い、スプレッドシートには書き込まない（認証も不要）")
+    args = parser.parse_args()
+    
+    if args.history is not None:
+        path = query_probability_path(args.history, days=args.days)
+        output = json.dumps(path, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output)
+            print(f"結果を書き出しました: {args.output}")
+        else:
+            print(output)
+    elif args.views is not None:
+        views = [v.strip() for v in args.views.split(",") if v.strip()] or None
+        tables = scrape_fed_views(views)
+        output = json.dumps(tables, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output)
+            print(f"結果を書き出しました: {args.output}")
+        else:
+            print(output)
+    elif args.dry_run:
         table_data = scrape_fed_data()
-        update_sheet(table_data)
-        print(f"成功: テーブル全体（{len(table_data['rows'])}行）をスプレッドシートに書き込みました")
-    except Exception as e:
-        print(f"エラー: {e}")
-        raise
\ No newline at end of file
+        print(f"ヘッダー: {table_data['header']}")
+        for row in table_data['rows']:
+            print(row)
+        print(f"取得のみ完了（{len(table_data['rows'])}行、スプレッドシートには書き込んでいません）")
+    elif args.live:
+        run_live(args.live_interval)
+    elif args.daemon:
+        run_daemon()
+    else:
+        try:
+            run_once()
+        except Exception as e:
+            print(f"エラー: {e}")
+            raise
@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import benchmark  # noqa: E402
+
+
+class FakeHttpError(Exception):
+    """googleapiclient の HttpError と同じく resp.status を持つエラー"""
+
+    def __init__(self, status, message="Requested entity was not found."):
+        super().__init__(message)
+        self.resp = types.SimpleNamespace(status=status)
+
+
+class StrictFakeSheetsService(benchmark.FakeSheetsService):
+    """_FakeGspreadClient が返すID以外のスプレッドシートには 404 を返す偽物
+
+    fail_batch_updates に入れた (エラー, 操作の種類) は、その種類の操作（None なら何でも）を含む
+    batchUpdate に先頭から1つずつ返す（何も変更しない）。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_batch_updates = []
+
+    def _check(self, spreadsheet_id, make_request):
+        if spreadsheet_id == 'benchmark':
+            return make_request()
+        def fail():
+            self._count('not_found')
+            raise FakeHttpError(404)
+        return benchmark._FakeRequest(fail)
+
+    def get(self, spreadsheetId, fields=None, range=None, **kwargs):
+        return self._check(spreadsheetId, lambda: super(StrictFakeSheetsService, self).get(
+            spreadsheetId, fields=fields, range=range, **kwargs))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return self._check(spreadsheetId, lambda: super(StrictFakeSheetsService, self).batchGet(
+            spreadsheetId, ranges, **kwargs))
+
+    def batchUpdate(self, spreadsheetId, body):
+        kinds = {kind for request in body['requests'] for kind in request}
+        if self.fail_batch_updates and self.fail_batch_updates[0][1] in kinds | {None}:
+            error, _ = self.fail_batch_updates.pop(0)
+            def fail():
+                raise error
+            return benchmark._FakeRequest(fail)
+        return self._check(spreadsheetId, lambda: super(StrictFakeSheetsService, self).batchUpdate(
+            spreadsheetId, body))
+
+
+@pytest.fixture
+def sheets(tmp_path, monkeypatch):
+    """Sheets API・Drive を偽物に、保存先を一時フォルダに切り替え、偽の Sheets API を返す"""
+    monkeypatch.chdir(tmp_path)
+    service = StrictFakeSheetsService()
+    monkeypatch.setattr(main, "_build_sheets_service", lambda: service)
+    monkeypatch.setattr(main, "_sheets_services", threading.local())
+    monkeypatch.setattr(main, "_target_executor", None)
+    monkeypatch.setattr(main, "_gc", benchmark._FakeGspreadClient())
+    monkeypatch.setattr(main, "_sheets_cache", None)
+    monkeypatch.setattr(main, "SHEETS_CACHE_FILE", str(tmp_path / "sheets_metadata.json"))
+    monkeypatch.setattr(main, "SPOOL_FILE", str(tmp_path / "pending_snapshots.jsonl"))
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_DIR", str(tmp_path / "history_archive"))
+    monkeypatch.setattr(main, "_trace", main._RunTrace())
+    monkeypatch.setattr(main, "GOOGLE_API_RETRIES", 0)
+    monkeypatch.setattr(main, "_quota_buckets", {
+        'read': main._TokenBucket(60000, capacity=10000),
+        'write': main._TokenBucket(60000, capacity=10000)
+    })
+    return service
+
+
+def make_table(probability):
+    """会合日1行・金利レンジ2列のヘッダーなしの表"""
+    return {
+        'header': [],
+        'rows': [['MEETING DATE', '300-325', '325-350'],
+                 ['2026/12/09', f'{probability}%', f'{100 - probability}%']],
+        'cell_colors': []
+    }
+
+
+def history_values(service):
+    """履歴シート（1枚目）のA列〜C列の値"""
+    return service._read("'シート1'").get('values', [])
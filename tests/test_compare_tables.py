@@ -0,0 +1,50 @@
+import main
+
+BUCKETS = ['MEETING DATE', '300-325', '325-350']
+
+
+def test_inserted_meeting_row_is_compared_by_meeting_date():
+    previous = [BUCKETS, ['2026/12/09', '50.0%', '50.0%']]
+    current = [BUCKETS, ['2026/10/28', '10.0%', '90.0%'], ['2026/12/09', '60.0%', '40.0%']]
+
+    rendered = main._compare_tables(current, previous, threshold=0.1)
+
+    assert rendered[1] == ['2026/10/28', '10.0%', '90.0%']
+    assert rendered[2] == ['2026/12/09', '60.0% ↑ +10.0%', '40.0% ↓ -10.0%']
+
+
+def test_moved_meeting_row_is_compared_by_meeting_date():
+    previous = [BUCKETS, ['2026/10/28', '10.0%', '90.0%'], ['2026/12/09', '50.0%', '50.0%']]
+    current = [BUCKETS, ['2026/12/09', '50.0%', '50.0%'], ['2026/10/28', '12.0%', '88.0%']]
+
+    rendered = main._compare_tables(current, previous, threshold=0.1)
+
+    assert rendered[1] == ['2026/12/09', '50.0% → ±0.0%', '50.0% → ±0.0%']
+    assert rendered[2] == ['2026/10/28', '12.0% ↑ +2.0%', '88.0% ↓ -2.0%']
+
+
+def test_table_without_bucket_row_is_compared_by_position():
+    previous = [['Dec 9', '50.0%', '50.0%']]
+    current = [['Dec 9', '55.0%', '50.0%']]
+
+    rendered = main._compare_tables(current, previous, threshold=0.1)
+
+    assert rendered == [['Dec 9', '55.0% ↑ +5.0%', '50.0% → ±0.0%']]
+
+
+def test_previous_cells_with_arrows_use_their_probability():
+    previous = [BUCKETS, ['2026/12/09', '28.0% ↑ +1.0%', '72.0% ↓ -1.0%']]
+    current = [BUCKETS, ['2026/12/09', '29.0%', '71.0%']]
+
+    rendered = main._compare_tables(current, previous, threshold=0.1)
+
+    assert rendered[1] == ['2026/12/09', '29.0% ↑ +1.0%', '71.0% ↓ -1.0%']
+
+
+def test_probability_records_fall_back_to_header():
+    table = {'header': BUCKETS, 'rows': [['2026/12/09', '28.0%', '72.0%']], 'cell_colors': []}
+
+    records = main._probability_records(table)
+
+    assert [(bucket, probability) for _, bucket, probability in records] == [('300-325', 28.0), ('325-350', 72.0)]
+    assert len({meeting_date for meeting_date, _, _ in records}) == 1
@@ -0,0 +1,24 @@
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+
+import main
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="/proc がない環境")
+def test_proc_sample_counts_chromium_descendants(tmp_path):
+    browser = tmp_path / "chromium-test"
+    shutil.copy(shutil.which("sleep"), browser)
+    child = subprocess.Popen([str(browser), "5"])
+    try:
+        time.sleep(0.2)
+        python_rss, browser_rss = main._proc_memory_sample()
+    finally:
+        child.kill()
+        child.wait()
+
+    assert python_rss > 0
+    assert browser_rss > 0
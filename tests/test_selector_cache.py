@@ -0,0 +1,23 @@
+import main
+
+
+def test_catch_all_fallback_stays_last_after_a_hit():
+    cache = main._SelectorCache("")
+    # quikstrikeのiframeがまだ追加されていない回に、最後の手段の "iframe" だけが一致した
+    cache.record("find_iframe", "iframe[src*='quikstrike']", hit=False)
+    cache.record("find_iframe", "iframe[src*='fedwatch']", hit=False)
+    cache.record("find_iframe", "iframe", hit=True)
+
+    ordered = cache.ordered("find_iframe", main.IFRAME_SELECTORS, main.IFRAME_FALLBACK_SELECTORS)
+
+    assert ordered == ["iframe[src*='quikstrike']", "iframe[src*='fedwatch']", "iframe"]
+
+
+def test_learned_selector_is_tried_first():
+    cache = main._SelectorCache("")
+    cache.record("find_iframe", "iframe[src*='quikstrike']", hit=False)
+    cache.record("find_iframe", "iframe[src*='fedwatch']", hit=True)
+
+    ordered = cache.ordered("find_iframe", main.IFRAME_SELECTORS, main.IFRAME_FALLBACK_SELECTORS)
+
+    assert ordered == ["iframe[src*='fedwatch']", "iframe[src*='quikstrike']", "iframe"]
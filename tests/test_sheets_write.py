@@ -0,0 +1,169 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import main
+from conftest import FakeHttpError, history_values, make_table
+
+
+def test_flush_spool_recovers_from_stale_cached_spreadsheet_id(sheets):
+    # 以前のスプレッドシート（作り直して別IDになったもの）のメタデータがキャッシュに残っている
+    main._load_sheets_cache()['spreadsheets'] = {
+        main.SPREADSHEET_NAME: {'id': 'stale', 'sheets': {
+            'シート1': {'sheetId': 0, 'title': 'シート1', 'index': 0, 'rowCount': 1000, 'columnCount': 26}
+        }}
+    }
+    main.spool_snapshot(make_table(50), datetime(2026, 10, 1, 9, 0).astimezone())
+
+    assert main.flush_spool() == 1
+
+    assert main._load_sheets_cache()['spreadsheets'][main.SPREADSHEET_NAME]['id'] == 'benchmark'
+    assert main._pending_snapshots() == []
+    assert history_values(sheets)[0][0] == "取得日時: 2026-10-01 09:00"
+
+
+def test_flush_spool_moves_permanently_failing_entry_aside(sheets):
+    main.update_sheet(make_table(40))
+    for minute, probability in enumerate((50, 51, 52)):
+        main.spool_snapshot(make_table(probability), datetime(2026, 10, 1, 9, minute).astimezone())
+    # まとめた書き込みと、先頭の取得結果だけの書き込みが 400 になる
+    sheets.fail_batch_updates += [(FakeHttpError(400, "Invalid requests"), None)] * 2
+
+    assert main.flush_spool() == 2
+
+    assert main._pending_snapshots() == []
+    with open(main._dead_letter_file(), encoding="utf-8") as f:
+        dead = [json.loads(line) for line in f]
+    assert [(entry['fetched_at'][:16], entry['status']) for entry in dead] == [("2026-10-01T09:00", 400)]
+    assert _block_times(_column_a(sheets, 'シート1'))[:2] == ["2026-10-01 09:02", "2026-10-01 09:01"]
+
+
+def _column_a(service, title):
+    return [row[0] if row else '' for row in service._read(f"'{title}'").get('values', [])]
+
+
+def _block_times(column_a):
+    return [fetched_at for _, _, fetched_at in main._history_blocks([[value] for value in column_a])]
+
+
+def test_archive_keeps_reused_state_in_sync(sheets, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_KEEP_SNAPSHOTS", 2)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_BATCH", 1)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_MODE", "sheet")
+    times = ['2026-01-10 09:00', '2026-01-20 09:00', '2026-02-05 09:00', '2026-02-15 09:00',
+             '2026-02-25 09:00', '2026-03-05 09:00', '2026-03-15 09:00']
+    state = {}  # ライブモード・スプールの複数バッチと同じく、1つの状態を使い回す
+    for index, fetched_at in enumerate(times):
+        assert main.write_snapshots([(make_table(50 + index), fetched_at)], state) == 1
+
+    history = _column_a(sheets, 'シート1')
+    assert _block_times(history) == ['2026-03-15 09:00', '2026-03-05 09:00', '2026-02-25 09:00']
+    for title, expected in [('アーカイブ_2026-01', ['2026-01-20 09:00', '2026-01-10 09:00']),
+                            ('アーカイブ_2026-02', ['2026-02-15 09:00', '2026-02-05 09:00'])]:
+        archived = _column_a(sheets, title)
+        assert _block_times(archived) == expected
+        assert '' not in archived  # 空のブロックやずれた行がない
+    # 使い回した状態の履歴のA列が、実際のシートと一致している
+    assert [row[0] if row else '' for row in state['history_head']] == history
+    assert state['history_sheet']['rowCount'] == sheets._sheets[0]['rows']
+
+
+def test_unchanged_marker_is_updated_on_each_unchanged_write(sheets, monkeypatch):
+    monkeypatch.setattr(main, "UNCHANGED_POLICY", "marker")
+    table = dict(make_table(50), header=['', 'TARGET RATE (BPS)'])  # ヘッダーがあれば2行目は空行
+    assert main.write_snapshots([(table, '2026-10-01 09:00')]) == 1
+    for fetched_at in ['2026-10-01 15:00', '2026-10-01 21:00']:
+        assert main.write_snapshots([(table, fetched_at)]) == 0
+
+    assert _column_a(sheets, 'シート1')[1] == "変化なし確認: 2026-10-01 21:00"
+
+
+def test_unchanged_marker_does_not_overwrite_headerless_data(sheets, monkeypatch):
+    monkeypatch.setattr(main, "UNCHANGED_POLICY", "marker")
+    assert main.write_snapshots([(make_table(50), '2026-10-01 09:00')]) == 1
+    assert main.write_snapshots([(make_table(50), '2026-10-01 15:00')]) == 0
+
+    assert _column_a(sheets, 'シート1')[:3] == ["取得日時: 2026-10-01 09:00", 'MEETING DATE', '2026/12/09']
+
+
+def test_live_flushes_reuse_state_across_archives(sheets, monkeypatch):
+    # ライブモードと同じく、スプール経由の書き込みで書き込み先ごとの状態を使い回す
+    monkeypatch.setattr(main, "HISTORY_KEEP_SNAPSHOTS", 2)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_BATCH", 1)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_MODE", "sheet")
+    states = {}
+    for index in range(7):
+        main.spool_snapshot(make_table(50 + index), datetime(2026, 10, 1, 9, index).astimezone())
+        assert main._write_snapshot(make_table(50 + index), states.setdefault(main.SPREADSHEET_NAME, {})) == 1
+
+    assert _block_times(_column_a(sheets, 'シート1')) == [f"2026-10-01 09:0{i}" for i in (6, 5, 4)]
+    archived = _column_a(sheets, 'アーカイブ_2026-10')
+    assert _block_times(archived) == [f"2026-10-01 09:0{i}" for i in (3, 2, 1, 0)]
+    assert '' not in archived
+    assert sheets.calls['values.batchGet'] == 1  # 状態の読み込みは最初の1回だけ
+
+
+def test_failed_batch_does_not_leave_grown_sizes_in_cache(sheets):
+    wide = {
+        'header': [],
+        'rows': [['MEETING DATE'] + [f"{300 + 25 * i}-{325 + 25 * i}" for i in range(30)],
+                 ['2026/12/09'] + ['3.3%'] * 30],
+        'cell_colors': []
+    }
+    assert main.update_sheet(make_table(50))  # 前回値シートの作成を済ませておく
+    sheets.fail_batch_updates.append((FakeHttpError(503, "Service Unavailable"), None))
+    with pytest.raises(FakeHttpError):
+        main.update_sheet(wide)
+    cached = main._load_sheets_cache()['spreadsheets'][main.SPREADSHEET_NAME]['sheets']['シート1']
+    assert cached['columnCount'] == 26  # 列を追加する前に失敗したので、元の列数のまま
+
+    assert main.update_sheet(wide)
+    assert sheets._sheets[0]['cols'] == cached['columnCount'] >= 31
+
+
+def test_unchanged_marker_skips_headerless_table_when_only_a1_is_read(sheets, monkeypatch):
+    monkeypatch.setattr(main, "UNCHANGED_POLICY", "marker")
+    monkeypatch.setattr(main, "HISTORY_KEEP_SNAPSHOTS", 0)  # 履歴のA列は先頭セルしか読まない
+    assert main.write_snapshots([(make_table(50), '2026-10-01 09:00')]) == 1
+    assert main.write_snapshots([(make_table(50), '2026-10-01 15:00')]) == 0
+
+    assert _column_a(sheets, 'シート1')[:3] == ["取得日時: 2026-10-01 09:00", 'MEETING DATE', '2026/12/09']
+
+
+def test_failed_archive_batch_leaves_no_empty_archive_sheet(sheets, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_KEEP_SNAPSHOTS", 2)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_BATCH", 1)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_MODE", "sheet")
+    for index in range(6):
+        fetched_at = f"2026-10-0{index + 1} 09:00"
+        if index == 3:  # 最初のアーカイブの回だけ1回失敗させる
+            sheets.fail_batch_updates.append((FakeHttpError(503, "Service Unavailable"), 'deleteDimension'))
+            with pytest.raises(FakeHttpError):
+                main.write_snapshots([(make_table(50 + index), fetched_at)])
+            assert 'アーカイブ_2026-10' not in [s['title'] for s in sheets._sheets.values()]
+        assert main.write_snapshots([(make_table(50 + index), fetched_at)]) == 1
+
+    archive_id, archive = next((sheet_id, sheet) for sheet_id, sheet in sheets._sheets.items()
+                               if sheet['title'] == 'アーカイブ_2026-10')
+    archived = _column_a(sheets, 'アーカイブ_2026-10')
+    assert _block_times(archived) == ['2026-10-04 09:00', '2026-10-03 09:00', '2026-10-02 09:00', '2026-10-01 09:00']
+    assert '' not in archived and archived[-1] != '---'
+    assert archive['rows'] == len(archived)
+    cached = main._load_sheets_cache()['spreadsheets'][main.SPREADSHEET_NAME]['sheets']['アーカイブ_2026-10']
+    assert cached['sheetId'] == archive_id and cached['rowCount'] == archive['rows']
+
+
+def test_target_pool_keeps_sheets_services_across_runs(sheets, monkeypatch):
+    built = []
+    monkeypatch.setattr(main, "SPREADSHEET_TARGETS", [main.SPREADSHEET_NAME])
+    monkeypatch.setattr(main, "_build_sheets_service", lambda: built.append(1) or sheets)
+
+    for probability in (50, 60, 70):
+        results, errors = main._for_each_target(
+            main._target_pool(), lambda name: main.update_sheet(make_table(probability), None, name),
+            main.SPREADSHEET_TARGETS)
+        assert errors == {}
+
+    assert main._target_pool() is main._target_pool()
+    assert len(built) == 1
@@ -0,0 +1,20 @@
+import main
+
+
+def test_only_rate_range_keys_become_probability_columns():
+    payload = {'data': [
+        {'date': '2026-12-09', '300-325': 0.5, '325-350': 0.5, 'id': 3, 'daysToMeeting': 50},
+        {'date': '2027-01-27', '300-325': 0.25, '325-350': 0.75, 'id': 4, 'daysToMeeting': 99}
+    ]}
+
+    table = main._table_from_json(payload)
+
+    assert table['rows'] == [['MEETING DATE', '300-325', '325-350'],
+                             ['2026-12-09', '50%', '50%'],
+                             ['2027-01-27', '25%', '75%']]
+
+
+def test_percent_values_are_kept_as_is():
+    table = main._table_from_json([{'date': '2026-12-09', '300-325': 88.4, '325-350': 11.6}])
+
+    assert table['rows'][1] == ['2026-12-09', '88.4%', '11.6%']